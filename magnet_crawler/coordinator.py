@@ -0,0 +1,109 @@
+"""
+start_multi_server 启动的多个爬虫之间的协调
+
+- 按 node id 的第一个字节把节点空间分给各个爬虫, 发现不属于自己的节点时批量转交给负责它的爬虫,
+  这样同一个节点只会被一个爬虫查询
+- 所有爬虫共用一个放在共享内存里的布隆过滤器对 info_hash 去重
+"""
+import copy
+import queue
+from multiprocessing import Queue
+from socket import inet_aton
+from threading import Lock
+
+from magnet_crawler.dedupe import SharedRotatingBloomFilter, BLOOM_MAX_BYTES, BLOOM_ERROR_RATE
+from magnet_crawler.krpc import random_id
+from magnet_crawler.utils import parse_nodes, COMPACT_NODE_STRUCT
+
+# 攒够这么多个节点再转交
+HANDOFF_BATCH_SIZE = 64
+# 每个爬虫的收件箱最多缓存的批数, 满了丢弃
+INBOX_MAX_SIZE = 1024
+# 每次最多从收件箱取出的批数
+INBOX_DRAIN_SIZE = 256
+
+
+class WorkerCoordinator:
+    def __init__(self, count, max_bytes=BLOOM_MAX_BYTES, error_rate=BLOOM_ERROR_RATE):
+        """
+        在父进程里创建, 作为参数传给每个爬虫进程, 子进程里再用 for_worker 得到每个爬虫自己的
+
+        :param count: 爬虫的数量
+        """
+        self.count = count
+        self.inboxes = [Queue(INBOX_MAX_SIZE) for _ in range(count)]
+        self.seen_hashes = SharedRotatingBloomFilter(max_bytes, error_rate)
+        self.index = None
+        self.outboxes = None
+        self.lock = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['lock'] = None
+        return state
+
+    def for_worker(self, index):
+        """第 index 个爬虫使用的副本, 和其他爬虫共用收件箱和布隆过滤器"""
+        worker = copy.copy(self)
+        worker.index = index
+        worker.outboxes = [[] for _ in range(self.count)]
+        worker.lock = Lock()
+        return worker
+
+    def owner(self, nid):
+        """负责该节点的爬虫"""
+        return nid[0] * self.count >> 8
+
+    def random_nid(self):
+        """
+        第一个字节在自己负责的范围里的随机 node id
+
+        自己负责的节点都和自己的 id 在同一段空间里, 才能分散到不同的 k-bucket,
+        否则它们全都落在同一个 bucket 里, 路由表最多只能保存一个 bucket 的节点
+        """
+        nid = random_id()
+        # owner(b) == index 的 b 是 [ceil(index * 256 / count), ceil((index + 1) * 256 / count))
+        low = -(-self.index * 256 // self.count)
+        high = -(-(self.index + 1) * 256 // self.count)
+        if high <= low:
+            return nid
+        return bytes((low + nid[0] % (high - low),)) + nid[1:]
+
+    def is_own(self, nid):
+        return self.owner(nid) == self.index
+
+    def forward(self, nid, ip, port):
+        """转交给负责它的爬虫"""
+        owner = self.owner(nid)
+        with self.lock:
+            outbox = self.outboxes[owner]
+            outbox.append(COMPACT_NODE_STRUCT.pack(nid, inet_aton(ip), port))
+            if len(outbox) < HANDOFF_BATCH_SIZE:
+                return
+            self.outboxes[owner] = []
+        self.send(owner, outbox)
+
+    def send(self, owner, nodes):
+        try:
+            self.inboxes[owner].put_nowait(b''.join(nodes))
+        except queue.Full:
+            pass
+
+    def flush(self):
+        """把没有攒够一批的节点也转交出去"""
+        with self.lock:
+            outboxes = [(owner, nodes) for owner, nodes in enumerate(self.outboxes) if nodes]
+            self.outboxes = [[] for _ in range(self.count)]
+        for owner, nodes in outboxes:
+            self.send(owner, nodes)
+
+    def receive(self):
+        """取出其他爬虫转交过来的节点"""
+        nodes = []
+        inbox = self.inboxes[self.index]
+        for _ in range(INBOX_DRAIN_SIZE):
+            try:
+                nodes.extend(parse_nodes(inbox.get_nowait()))
+            except queue.Empty:
+                break
+        return nodes
@@ -1,4 +1,9 @@
+import asyncio
+import os
+import selectors
+import signal
 import socket
+import sys
 import time
 from bencoder import bdecode, bencode
 from collections import deque
@@ -6,57 +11,147 @@ from multiprocessing import Process
 from os import cpu_count
 from threading import Thread
 
+from magnet_crawler.coordinator import WorkerCoordinator
 from magnet_crawler.database import RedisClient
-from magnet_crawler.utils import get_random_id, parse_nodes, parse_info_hash, get_logger
+from magnet_crawler.dedupe import RotatingBloomFilter
+from magnet_crawler.krpc import encode_find_node, encode_sample_infohashes, random_id, encode_ping_response, \
+    encode_find_node_response, encode_get_peers_response, encode_announce_peer_response, encode_error, \
+    get_neighbor_id, is_id, TokenManager, ERROR_PROTOCOL
+from magnet_crawler.routing import DHTNode, RoutingTable
+from magnet_crawler.transaction import TransactionTable, RateController
+from magnet_crawler.utils import parse_nodes, pack_nodes, parse_nodes6, pack_nodes6, pack_peer, \
+    info_hash_to_magnet, get_logger
 
 BOOTSTRAP_NODES = [
     ("router.bittorrent.com", 6881),
     ("dht.transmissionbt.com", 6881),
     ("router.utorrent.com", 6881),
 ]
+# 有 IPv6 地址的引导节点
+BOOTSTRAP_NODES6 = [
+    ("dht.transmissionbt.com", 6881),
+    ("dht.libtorrent.org", 25401),
+]
 MAX_NODES_SIZE = 10000
+# 路由表每个 k-bucket 的容量, 爬虫需要尽量多的节点, 所以比 Kademlia 的 8 大得多
+BUCKET_SIZE = 1024
 BUFSIZE = 10240
-# 发送间隔时间
-SLEEP_TIME = 1e-6
-MAGNET_TEMPLATE = "magnet:?xt=urn:btih:{}"
 SERVER_HOST = '0.0.0.0'
+SERVER_HOST6 = '::'
 DEFAULT_SERVER_PORT = 10086
 DEFAULT_SERVER_COUNT = cpu_count()
 TIMER_WAIT_TIME = 60
-
-
-class DHTNode:
-    def __init__(self, nid, ip, port):
-        self.nid = nid
-        self.ip = ip
-        self.port = port
+# 运行模式: thread 为三个线程, async 为 asyncio 事件循环
+# batch 模式为单线程非阻塞 socket, 批量收发
+SERVER_MODES = ('thread', 'async', 'batch')
+DEFAULT_SERVER_MODE = 'thread'
+# async 模式下每个进程绑定的 socket 数量
+DEFAULT_SOCKETS_PER_PROCESS = 1
+# async 模式下连续发送多少个包后让出事件循环
+ASYNC_SEND_BATCH = 64
+# 没有可以查询的节点时的等待时间
+IDLE_TIME = 1
+# socket 接收缓冲区大小, 调大可以减少 python 处理不过来时内核的丢包
+# 实际大小受 /proc/sys/net/core/rmem_max 限制
+RCVBUF_SIZE = 4 * 1024 * 1024
+# batch 模式下每一轮最多连续接收的包数
+RECV_BATCH_SIZE = 256
+# batch 模式下每一轮最多连续发送的包数
+SEND_BATCH_SIZE = 256
+# batch 模式下 select 的超时时间
+BATCH_SELECT_TIMEOUT = 1
+# 定时任务(清理超时请求, 写入 redis 缓冲)的间隔
+HOUSEKEEPING_INTERVAL = 1
+# 路由表快照的保存目录和保存间隔, 重启时从快照恢复节点, 不需要重新从 BOOTSTRAP_NODES 开始
+SNAPSHOT_DIR = os.path.abspath('./nodes')
+SNAPSHOT_INTERVAL = 300
+# BEP 51 sample_infohashes 主动采集: 单独的发送速率(包/秒)
+SAMPLE_RATE = 100
+SAMPLE_MAX_RATE = 2000
+# 节点回复的 interval 的上限, BEP 51 规定最大 6 小时
+SAMPLE_MAX_INTERVAL = 6 * 60 * 60
+# 不支持 sample_infohashes 的节点, 这么久之后再试
+SAMPLE_UNSUPPORTED_INTERVAL = 6 * 60 * 60
 
 
 class DHTServer:
-    def __init__(self, bind_ip, bind_port, name):
+    def __init__(self, bind_ip, bind_port, name, rcvbuf=RCVBUF_SIZE, coordinator=None, snapshot_path=None,
+                 sample=False, family=socket.AF_INET, sibling=None):
         """
 
         :param bind_ip: 绑定的ip
         :param bind_port: 绑定的端口
         :param name: 该server的名字
+        :param rcvbuf: socket 接收缓冲区大小
+        :param coordinator: 多个爬虫一起运行时, 用于和其他爬虫共享节点和 info_hash
+        :param snapshot_path: 路由表快照文件, 默认按端口保存在 SNAPSHOT_DIR 里
+        :param sample: 是否用 sample_infohashes 主动采集 info_hash
+        :param family: socket.AF_INET 或 socket.AF_INET6
+        :param sibling: 同一个爬虫的另一个地址族的 server, 和它使用同一个 node id, 共用去重和 redis (BEP 32)
         """
-        # 自己也是一个node
-        self.node = DHTNode(get_random_id(20), bind_ip, bind_port)
+        self.family = family
+        self.sibling = sibling
+        # 自己也是一个node, 多个爬虫时 node id 在自己负责的那部分空间里
+        if sibling:
+            nid = sibling.node.nid
+        elif coordinator and family == socket.AF_INET:
+            nid = coordinator.random_nid()
+        else:
+            nid = random_id()
+        self.node = DHTNode(nid, bind_ip, bind_port)
         # 使用udp
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.udp_socket = socket.socket(family, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if family == socket.AF_INET6:
+            # IPv4 由另一个 socket 负责, 两个 socket 可以绑定同一个端口
+            self.udp_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
         self.udp_socket.bind((bind_ip, bind_port))
+        # async 模式下由 DHTProtocol 设置
+        self.transport = None
+        # batch 模式下待发送的 (data, address)
+        self.send_queue = deque()
+        self.batch_send = False
         # 存放发现的nodes
-        self.nodes = deque(maxlen=MAX_NODES_SIZE)
-        self.magnets = set()
-        self.redis_client = RedisClient()
+        self.routing_table = RoutingTable(self.node.nid, BUCKET_SIZE, MAX_NODES_SIZE, family)
+        self.token_manager = TokenManager()
+        # 等待回复的请求和发送速率控制, 代替固定的发送间隔
+        self.transactions = TransactionTable()
+        self.rate_controller = RateController()
+        self.last_housekeeping = time.time()
+        # sample_infohashes 主动采集, 有自己的发送速率和计数
+        self.sample = sample
+        self.sample_rate_controller = RateController(rate=SAMPLE_RATE, max_rate=SAMPLE_MAX_RATE)
+        self.sample_candidates = deque()
+        # 这个时间之前路由表里没有可以发送 sample_infohashes 的节点, 不用再扫描
+        self.sample_idle_until = 0
+        self.sample_sent = 0
+        self.sample_responses = 0
+        self.sample_hashes = 0
+        self.sample_new_hashes = 0
+        # 在爬虫之间转交的是 IPv4 节点, IPv6 的 server 不参与
+        self.coordinator = coordinator if family == socket.AF_INET else None
+        if sibling:
+            sibling.sibling = self
+            self.seen_hashes = sibling.seen_hashes
+            self.redis_client = sibling.redis_client
+        else:
+            # 见过的 info_hash, 内存固定的布隆过滤器, 多个爬虫时共用一个
+            self.seen_hashes = coordinator.seen_hashes if coordinator else RotatingBloomFilter()
+            self.redis_client = RedisClient()
+        self.magnet_count = 0
+        self.duplicate_count = 0
         self.logger = get_logger(name)
         self.logger.info("I'am {}, I'm bound at port:{}.".format(name, bind_port))
+        self.logger.info('SO_RCVBUF is {}'.format(self.udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
+        self.snapshot_path = snapshot_path if snapshot_path else os.path.join(
+            SNAPSHOT_DIR, '{}-{}.dat'.format('nodes6' if family == socket.AF_INET6 else 'nodes', bind_port))
+        self.last_snapshot = time.time()
+        self.load_snapshot()
 
     def join_dht(self):
         """从本地提供的节点加入 DHT 网络"""
-        for addr in BOOTSTRAP_NODES:
+        for addr in BOOTSTRAP_NODES6 if self.family == socket.AF_INET6 else BOOTSTRAP_NODES:
             self.send_find_node_request(addr)
-            time.sleep(SLEEP_TIME)
 
     def send_find_node_request(self, address, nid=None):
         """
@@ -77,29 +172,46 @@ class DHTServer:
                 'target': node_id, 正在查找的节点 id
             }
 
+        使用 krpc 里预先编码好的模板, 不再构造字典和 bencode
         """
         nid = nid if nid else self.node.nid
-        tid = get_random_id(4)
-        target = get_random_id(20)
-        data = {
-            't': tid,
-            'y': 'q',
-            'q': 'find_node',
-            'a': {
-                'id': nid,
-                'target': target
-            }
-        }
-        self.send_krpc(data, address)
+        self.logger.debug("I'm sending to {}".format(address))
+        try:
+            tid = self.transactions.add(address, 'find_node')
+            self.sendto(encode_find_node(tid, nid, random_id()), address)
+        except Exception:
+            self.logger.exception(Exception)
 
     def send_krpc(self, data, address):
         """发送 krpc 信息"""
+        self.send_message(bencode(data), address)
+
+    def send_message(self, message, address):
+        """发送已经编码好的 krpc 信息"""
         self.logger.debug("I'm sending to {}".format(address))
         try:
-            self.udp_socket.sendto(bencode(data), address)
+            self.sendto(message, address)
         except Exception:
             self.logger.exception(Exception)
 
+    def sendto(self, data, address):
+        """async 模式下交给 transport 发送, batch 模式下放入发送队列, 否则直接用 socket 发送"""
+        if self.transport:
+            self.transport.sendto(data, address)
+        elif self.batch_send:
+            self.send_queue.append((data, address))
+        else:
+            self.udp_socket.sendto(data, address)
+
+    def handle_datagram(self, data, address):
+        """解码并处理一个 udp 包"""
+        try:
+            # IPv6 的地址是 (ip, port, flowinfo, scope_id), 只保留 (ip, port)
+            self.handle_receive_things(bdecode(data), address[:2])
+        except Exception:
+            pass
+            # self.logger.exception(Exception)
+
     def handle_receive_things(self, data, address):
         """处理接收到的所有信息"""
         try:
@@ -108,21 +220,100 @@ class DHTServer:
             # y = 'q', 表示当前是请求
             if y == b'r':
                 if data.get(b'r'):
-                    self.handle_find_node_response(data)
+                    self.handle_response(data, address)
+            elif y == b'e':
+                self.handle_error(data, address)
             elif y == b'q':
                 # 关键字 q , 表示当前请求的方法名
                 q = data.get(b'q')
-                if q == b'get_peers':
-                    if data.get(b'a'):
-                        self.handle_get_peers_request(data, address)
+                if not data.get(b'a') or data.get(b't') is None:
+                    return
+                self.handle_query_node(data, address)
+                if q == b'ping':
+                    self.handle_ping_request(data, address)
+                elif q == b'find_node':
+                    self.handle_find_node_request(data, address)
+                elif q == b'get_peers':
+                    self.handle_get_peers_request(data, address)
                 elif q == b'announce_peer':
-                    if data.get(b'a'):
-                        self.handle_announce_peer_request(data, address)
+                    self.handle_announce_peer_request(data, address)
         except KeyError:
             pass
             # self.logger.exception(KeyError)
 
-    def handle_find_node_response(self, data):
+    def handle_response(self, data, address):
+        """用 tid 找到对应的请求, 记录 RTT, 再按请求的类型处理回复"""
+        transaction = self.transactions.pop(data.get(b't'))
+        if transaction:
+            rtt = time.time() - transaction.sent_at
+            self.routing_table.mark_seen(address, rtt)
+            self.get_rate_controller(transaction).on_response(rtt)
+            if transaction.query == 'sample_infohashes':
+                self.handle_sample_infohashes_response(data, address)
+                return
+        else:
+            self.routing_table.mark_seen(address)
+        self.handle_find_node_response(data, address)
+
+    def handle_error(self, data, address):
+        """对方回复了错误, 一般是不支持 sample_infohashes"""
+        transaction = self.transactions.pop(data.get(b't'))
+        if not transaction:
+            return
+        self.get_rate_controller(transaction).on_response(time.time() - transaction.sent_at)
+        if transaction.query == 'sample_infohashes':
+            node = self.routing_table.get(address)
+            if node:
+                node.sample_after = time.time() + SAMPLE_UNSUPPORTED_INTERVAL
+
+    def get_rate_controller(self, transaction):
+        if transaction.query == 'sample_infohashes':
+            return self.sample_rate_controller
+        return self.rate_controller
+
+    def housekeeping(self):
+        """由发送循环调用的定时任务"""
+        now = time.time()
+        if now - self.last_housekeeping < HOUSEKEEPING_INTERVAL:
+            return
+        self.last_housekeeping = now
+        self.check_transactions()
+        self.redis_client.flush_if_due()
+        if self.coordinator:
+            self.coordinator.flush()
+            for nid, ip, port in self.coordinator.receive():
+                self.routing_table.add(nid, ip, port)
+        if now - self.last_snapshot > SNAPSHOT_INTERVAL:
+            self.last_snapshot = now
+            self.save_snapshot()
+
+    def load_snapshot(self):
+        """从快照恢复路由表"""
+        count = 0
+        for node in self.routing_table.read_snapshot(self.snapshot_path, self.family):
+            if self.coordinator and not self.coordinator.is_own(node.nid):
+                self.coordinator.forward(node.nid, node.ip, node.port)
+            elif self.routing_table.restore(node):
+                count += 1
+        if count:
+            self.logger.info('load {} nodes from {}'.format(count, self.snapshot_path))
+
+    def save_snapshot(self):
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+            count = self.routing_table.save(self.snapshot_path)
+            self.logger.info('save {} nodes to {}'.format(count, self.snapshot_path))
+        except OSError:
+            self.logger.exception(OSError)
+
+    def check_transactions(self):
+        """清理超时的请求, 记为节点失败并通知速率控制"""
+        expired = self.transactions.expire()
+        for transaction in expired:
+            self.routing_table.mark_failed(transaction.address)
+            self.get_rate_controller(transaction).on_timeout()
+
+    def handle_find_node_response(self, data, address):
         """
         处理 find_node 的回复
 
@@ -130,66 +321,260 @@ class DHTServer:
                 'id': 发送方的 node id
 
                 'nodes': 离 target 最近的 k 个节点
+
+                'nodes6': 离 target 最近的 k 个 IPv6 节点
             }
         """
         self.logger.debug("I'm handling find_node_response")
         try:
-            tid = data.get(b't')
-            nid = data.get(b'r').get(b'id')
-            nodes = data.get(b'r').get(b'nodes')
-            nodes = parse_nodes(nodes)
-            for node in nodes:
-                nid, ip, port = node
-                if len(nid) == 20 and ip != SERVER_HOST:
-                    self.nodes.append(DHTNode(nid, ip, port))
+            self.add_response_nodes(data.get(b'r'))
         except KeyError:
             pass
             # self.logger.exception(KeyError)
 
+    def handle_sample_infohashes_response(self, data, address):
+        """
+        处理 sample_infohashes 的回复, samples 和 get_peers 收到的 info_hash 一样储存
+
+        'r': {
+                'id': 发送方的 node id
+
+                'interval': 多少秒之后才能再次请求
+
+                'nodes': 离 target 最近的节点
+
+                'num': 对方储存的 info_hash 总数
+
+                'samples': 多个 20 字节的 info_hash 连在一起
+            }
+        """
+        self.logger.debug("I'm handling sample_infohashes_response")
+        r = data.get(b'r')
+        samples = r.get(b'samples')
+        node = self.routing_table.get(address)
+        if samples is None:
+            # 不支持 sample_infohashes, 只回复了 nodes
+            if node:
+                node.sample_after = time.time() + SAMPLE_UNSUPPORTED_INTERVAL
+        else:
+            self.sample_responses += 1
+            if node:
+                interval = r.get(b'interval', 0)
+                interval = min(interval, SAMPLE_MAX_INTERVAL) if isinstance(interval, int) else 0
+                node.sample_after = time.time() + interval
+            for i in range(0, len(samples) - len(samples) % 20, 20):
+                self.sample_hashes += 1
+                if self.save_magnet(samples[i:i + 20]):
+                    self.sample_new_hashes += 1
+        self.add_response_nodes(r)
+
+    def next_sample_node(self):
+        """
+        轮流取出路由表里到了 interval 的节点, 没有返回 None
+
+        扫描整张路由表没有找到时, 记录最早的节点到期的时间(最多 IDLE_TIME, 期间可能加入新节点),
+        在这之前直接返回 None. batch 模式每一轮都会调用, 不这样每一轮都要扫描一次路由表
+        """
+        now = time.time()
+        if not self.sample_candidates:
+            if now < self.sample_idle_until:
+                return None
+            next_time = now + IDLE_TIME
+            for node in self.routing_table:
+                if node.sample_after <= now:
+                    self.sample_candidates.append(node)
+                elif node.sample_after < next_time:
+                    next_time = node.sample_after
+            if not self.sample_candidates:
+                self.sample_idle_until = next_time
+        while self.sample_candidates:
+            node = self.sample_candidates.popleft()
+            if node.sample_after <= now and node.address in self.routing_table:
+                return node
+        return None
+
+    def send_sample_infohashes_request(self, node):
+        """发送 sample_infohashes 请求, target 随机, 可以顺便发现更多节点"""
+        # 在收到回复之前不再向它发送
+        node.sample_after = time.time() + self.transactions.timeout
+        self.sample_sent += 1
+        tid = self.transactions.add(node.address, 'sample_infohashes')
+        self.send_message(encode_sample_infohashes(tid, self.node.nid, random_id()), node.address)
+
+    def send_sample_requests(self):
+        """按 sample_infohashes 的发送速率发送, 返回是否还有可以发送的节点"""
+        while not self.sample_rate_controller.wait_time():
+            node = self.next_sample_node()
+            if node is None:
+                return False
+            self.sample_rate_controller.take()
+            self.send_sample_infohashes_request(node)
+        return True
+
+    def sample_forever(self):
+        """thread 模式下一直发送 sample_infohashes"""
+        self.logger.info('start sample forever...')
+        while True:
+            if not self.send_sample_requests():
+                time.sleep(IDLE_TIME)
+            else:
+                time.sleep(self.sample_rate_controller.wait_time())
+
+    async def sample_forever_async(self):
+        """async 模式下一直发送 sample_infohashes"""
+        self.logger.info('start sample forever (async)...')
+        while True:
+            if not self.send_sample_requests():
+                await asyncio.sleep(IDLE_TIME)
+            else:
+                await asyncio.sleep(self.sample_rate_controller.wait_time())
+
+    def get_server(self, family):
+        """负责该地址族的 server, 没有返回 None"""
+        if family == self.family:
+            return self
+        if self.sibling and self.sibling.family == family:
+            return self.sibling
+        return None
+
+    def add_response_nodes(self, r):
+        """回复里的 nodes 和 nodes6 分别加入 IPv4 和 IPv6 的路由表, parse_nodes 已经过滤掉了无效的地址"""
+        for family, key, parse in ((socket.AF_INET, b'nodes', parse_nodes),
+                                   (socket.AF_INET6, b'nodes6', parse_nodes6)):
+            server = self.get_server(family)
+            if server:
+                for nid, ip, port in parse(r.get(key)):
+                    server.add_node(nid, ip, port)
+
+    def get_closest_nodes(self, data, target):
+        """
+        按请求里的 want 返回 (nodes, nodes6), 不需要的为 None
+
+        没有 want 时只回复和请求同一个地址族的节点(BEP 32)
+        """
+        want = data.get(b'a').get(b'want')
+        families = set()
+        if isinstance(want, list):
+            if b'n4' in want:
+                families.add(socket.AF_INET)
+            if b'n6' in want:
+                families.add(socket.AF_INET6)
+        families = families or {self.family}
+        result = []
+        for family, pack in ((socket.AF_INET, pack_nodes), (socket.AF_INET6, pack_nodes6)):
+            server = self.get_server(family) if family in families else None
+            result.append(pack(server.routing_table.closest(target)) if server else None)
+        nodes, nodes6 = result
+        if nodes is None and nodes6 is None:
+            nodes = b''
+        return nodes, nodes6
+
+    def add_node(self, nid, ip, port):
+        """加入路由表, 不属于自己的节点转交给负责它的爬虫"""
+        if self.coordinator and not self.coordinator.is_own(nid):
+            self.coordinator.forward(nid, ip, port)
+            return None
+        return self.routing_table.add(nid, ip, port)
+
+    def handle_query_node(self, data, address):
+        """发来请求的节点是活着的, 加入路由表"""
+        nid = data.get(b'a').get(b'id')
+        if nid and self.add_node(nid, *address):
+            self.routing_table.mark_seen(address)
+
+    def handle_ping_request(self, data, address):
+        """
+        回复 ping 请求
+
+        'a': {
+                'id': node_id, 请求节点的 id
+            }
+        """
+        self.logger.debug("I'm handling ping_request")
+        tid = data.get(b't')
+        self.send_message(encode_ping_response(tid, self.node.nid), address)
+
+    def handle_find_node_request(self, data, address):
+        """
+        回复 find_node 请求, 从路由表里取离 target 最近的节点
+
+        'a': {
+                'id': node_id, 请求节点的 id
+
+                'target': node_id, 正在查找的节点 id
+
+                'want': ['n4', 'n6'], 需要 IPv4 还是 IPv6 的节点, 可选
+            }
+        """
+        self.logger.debug("I'm handling find_node_request")
+        tid = data.get(b't')
+        target = data.get(b'a').get(b'target')
+        if not is_id(target):
+            # 长度不对的 id 放进回复模板会得到不合法的 bencode
+            self.send_message(encode_error(tid, ERROR_PROTOCOL, b'Invalid target'), address)
+            return
+        nodes, nodes6 = self.get_closest_nodes(data, target)
+        self.send_message(encode_find_node_response(tid, get_neighbor_id(target, self.node.nid), nodes, nodes6),
+                          address)
+
     def handle_get_peers_request(self, data, address):
         """
         处理外部发来的 get_peers 请求，使用 info_hash 转为 magnet
 
+        回复离 info_hash 最近的节点和 announce_peer 需要的 token
+
         'a': {
                 'id': node_id, 请求节点的 id
 
                 'info_hash': 请求的资源的 info_hash
+
+                'want': ['n4', 'n6'], 可选
             }
         """
         self.logger.debug("I'm handling get_peers_request")
-        try:
-            tid = data.get(b't')
-            nid = data.get(b'a').get(b'id')
-            info_hash = data.get(b'a').get(b'info_hash')
-            magnet = parse_info_hash(info_hash)
-            # TODO: 储存 info_hash, 并回复
-            self.save_magnet(magnet)
-        except KeyError:
-            pass
-            # self.logger.exception(KeyError)
+        tid = data.get(b't')
+        info_hash = data.get(b'a').get(b'info_hash')
+        if not is_id(info_hash):
+            self.send_message(encode_error(tid, ERROR_PROTOCOL, b'Invalid info_hash'), address)
+            return
+        self.save_magnet(info_hash)
+        nodes, nodes6 = self.get_closest_nodes(data, info_hash)
+        token = self.token_manager.get(address[0])
+        self.send_message(encode_get_peers_response(tid, get_neighbor_id(info_hash, self.node.nid), nodes, token,
+                                                    nodes6), address)
 
     def handle_announce_peer_request(self, data, address):
         """
         处理外部发来的 announce_peer 请求，使用 info_hash 转为 magnet
 
+        token 正确才回复, 否则回复错误. 不管 token 是否正确, info_hash 都会被储存.
+        token 正确时还会保存这个 peer 的地址, 转换时先从它下载 metadata
+
         'a': {
                 'id': node_id, 请求节点的 id
 
                 'info_hash': 请求的资源的 info_hash
+
+                'port': peer 的端口
+
+                'implied_port': 为 1 时使用发送请求的 udp 端口作为 peer 的端口
+
+                'token': 之前 get_peers 回复里的 token
             }
         """
         self.logger.debug("I'm handling announce_peer_request")
-        print(data)
-        try:
-            tid = data.get(b't')
-            nid = data.get(b'a').get(b'id')
-            info_hash = data.get(b'a').get(b'info_hash')
-            magnet = parse_info_hash(info_hash)
-            # TODO: 储存 info_hash, 并回复
-            self.save_magnet(magnet)
-        except KeyError:
-            pass
-            # self.logger.exception(KeyError)
+        tid = data.get(b't')
+        info_hash = data.get(b'a').get(b'info_hash')
+        if not is_id(info_hash):
+            self.send_message(encode_error(tid, ERROR_PROTOCOL, b'Invalid info_hash'), address)
+            return
+        self.save_magnet(info_hash)
+        token = data.get(b'a').get(b'token', b'')
+        if self.token_manager.check(token, address[0]):
+            self.save_peer(info_hash, address, data.get(b'a'))
+            self.send_message(encode_announce_peer_response(tid, get_neighbor_id(info_hash, self.node.nid)), address)
+        else:
+            self.send_message(encode_error(tid, ERROR_PROTOCOL, b'Bad token'), address)
 
     def receive_forever(self):
         """一直接收外部发来的信息"""
@@ -197,58 +582,340 @@ class DHTServer:
         while True:
             try:
                 data, addr = self.udp_socket.recvfrom(BUFSIZE)
-                self.handle_receive_things(bdecode(data), addr)
             except Exception:
-                pass
-                # self.logger.exception(Exception)
+                continue
+            self.handle_datagram(data, addr)
 
     def send_forever(self):
         """一直对外发送信息，即发送 find_node"""
         self.logger.info('start send forever...')
         while True:
+            self.housekeeping()
+            wait = self.rate_controller.wait_time()
+            if wait:
+                time.sleep(wait)
+                continue
+            node = self.routing_table.next_node()
+            if node is None:
+                self.join_if_empty()
+                time.sleep(IDLE_TIME)
+                continue
+            self.rate_controller.take()
+            self.send_find_node_request(node.address, node.nid)
+
+    def join_if_empty(self):
+        """
+        路由表为空时重新加入 DHT 网络
+
+        多个爬虫时只由第一个加入, 其他爬虫等待转交过来的节点, 仍然会在 reporter 里定时加入
+        """
+        if not self.routing_table and (not self.coordinator or self.coordinator.index == 0):
+            self.join_dht()
+
+    def receive_batch(self):
+        """从非阻塞 socket 连续接收, 直到没有数据(EAGAIN)或达到 RECV_BATCH_SIZE"""
+        count = 0
+        for _ in range(RECV_BATCH_SIZE):
             try:
-                node = self.nodes.popleft()
-                self.send_find_node_request((node.ip, node.port), node.nid)
-                time.sleep(SLEEP_TIME)
-            except IndexError:
+                data, addr = self.udp_socket.recvfrom(BUFSIZE)
+            except BlockingIOError:
+                break
+            except OSError:
+                # 比如 ICMP 端口不可达导致的 ConnectionRefusedError
+                continue
+            self.handle_datagram(data, addr)
+            count += 1
+        return count
+
+    def flush_send_queue(self):
+        """批量发送队列里的数据, 内核发送缓冲区满(EAGAIN)时停止, 剩下的留到下一轮"""
+        count = 0
+        while self.send_queue and count < SEND_BATCH_SIZE:
+            data, address = self.send_queue[0]
+            try:
+                self.udp_socket.sendto(data, address)
+            except BlockingIOError:
+                break
+            except OSError:
+                self.logger.debug("can't send to {}".format(address))
+            self.send_queue.popleft()
+            count += 1
+        return count
+
+    def fill_send_queue(self):
+        """按发送速率从路由表取出节点生成 find_node 请求, 放入发送队列"""
+        while len(self.send_queue) < SEND_BATCH_SIZE and not self.rate_controller.wait_time():
+            node = self.routing_table.next_node()
+            if node is None:
+                return False
+            self.rate_controller.take()
+            self.send_find_node_request(node.address, node.nid)
+        return True
+
+    def batch_forever(self):
+        """单线程运行, 使用非阻塞 socket 批量收发"""
+        self.logger.info('start batch forever...')
+        self.batch_send = True
+        self.udp_socket.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.udp_socket, selectors.EVENT_READ)
+        last_join = last_report = time.time()
+        while True:
+            now = time.time()
+            self.housekeeping()
+            has_nodes = self.fill_send_queue()
+            if self.sample:
+                self.send_sample_requests()
+            if not has_nodes and not self.send_queue and now - last_join > IDLE_TIME:
+                self.join_if_empty()
+                last_join = now
+            if now - last_report > TIMER_WAIT_TIME:
                 self.join_dht()
-
-    def save_magnet(self, magnet):
-        self.logger.info(MAGNET_TEMPLATE.format(magnet))
-        self.magnets.add(MAGNET_TEMPLATE.format(magnet))
-        self.redis_client.add(MAGNET_TEMPLATE.format(magnet))
+                self.report()
+                last_report = now
+
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if self.send_queue else selectors.EVENT_READ
+            selector.modify(self.udp_socket, events)
+            # 还有节点可以查询时, 只等到发送速率允许发送下一个包
+            timeout = min(BATCH_SELECT_TIMEOUT, self.rate_controller.wait_time()) if has_nodes else BATCH_SELECT_TIMEOUT
+            for _, mask in selector.select(timeout):
+                if mask & selectors.EVENT_READ:
+                    self.receive_batch()
+                if mask & selectors.EVENT_WRITE:
+                    self.flush_send_queue()
+
+    def save_magnet(self, info_hash):
+        """储存 info_hash, 本进程见过的直接跳过, 不再发给 redis. 是新的 info_hash 返回 True"""
+        if len(info_hash) != 20:
+            return False
+        if not self.seen_hashes.add(info_hash):
+            self.duplicate_count += 1
+            return False
+        self.magnet_count += 1
+        self.logger.info(info_hash_to_magnet(info_hash))
+        # redis 里直接存 20 字节的 info_hash
+        self.redis_client.buffer_add(info_hash)
+        return True
+
+    def save_peer(self, info_hash, address, args):
+        """保存 announce_peer 的 peer 地址, 重复的 info_hash 也保存, peer 地址是新的"""
+        port = address[1] if args.get(b'implied_port') == 1 else args.get(b'port')
+        if len(info_hash) != 20 or not isinstance(port, int) or not 0 < port < 65536:
+            return
+        self.redis_client.buffer_add_peer(info_hash, pack_peer(address[0], port))
+
+    def close(self):
+        """退出前把缓冲的 magnet 写入 redis"""
+        self.logger.info('closing...')
+        self.save_snapshot()
+        # 和 sibling 共用的 redis_client 会被 flush 两次, 第二次缓冲已经是空的
+        self.redis_client.close()
+        self.udp_socket.close()
 
     def reporter(self):
         """定时报告当前状况"""
         while True:
             time.sleep(TIMER_WAIT_TIME)
             self.join_dht()
-            self.logger.info('当前有{}个节点, 有{}个磁力链接'.format(len(self.nodes), len(self.magnets)))
+            self.report()
+
+    def report(self):
+        self.logger.info('当前有{}个节点, 有{}个磁力链接, 跳过{}个重复的'.format(
+            len(self.routing_table), self.magnet_count, self.duplicate_count))
+        self.logger.info('发送速率{:.0f}/s, 等待回复{}个, 回复率{:.1%}'.format(
+            self.rate_controller.rate, len(self.transactions), self.transactions.answer_rate))
+        if self.sample:
+            self.logger.info('sample_infohashes: 速率{:.0f}/s, 发送{}个, 回复{}个, 收到{}个 info_hash, 其中{}个是新的'.format(
+                self.sample_rate_controller.rate, self.sample_sent, self.sample_responses, self.sample_hashes,
+                self.sample_new_hashes))
+
+    async def send_forever_async(self, protocol):
+        """async 模式下按发送速率一直发送 find_node, 每发送一批让出一次事件循环"""
+        self.logger.info('start send forever (async)...')
+        sent = 0
+        while True:
+            # 内核发送缓冲区满时, transport 会暂停协议, 等待恢复后再发送
+            await protocol.writable.wait()
+            self.housekeeping()
+            wait = self.rate_controller.wait_time()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            node = self.routing_table.next_node()
+            if node is None:
+                self.join_if_empty()
+                await asyncio.sleep(IDLE_TIME)
+                continue
+            self.rate_controller.take()
+            self.send_find_node_request(node.address, node.nid)
+            sent += 1
+            if sent % ASYNC_SEND_BATCH == 0:
+                await asyncio.sleep(0)
+
+    async def reporter_async(self):
+        """async 模式下定时报告当前状况"""
+        while True:
+            await asyncio.sleep(TIMER_WAIT_TIME)
+            self.join_dht()
+            self.report()
+
+
+class DHTProtocol(asyncio.DatagramProtocol):
+    """把 DHTServer 接入 asyncio 事件循环, 收发由事件循环统一调度"""
+
+    def __init__(self, server):
+        self.server = server
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        # udp 会收到 ICMP 不可达之类的错误, 直接忽略
+        pass
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
 
+    def connection_lost(self, exc):
+        self.server.transport = None
 
-def start_server(index=0, bind_port=DEFAULT_SERVER_PORT):
-    dht_s = DHTServer(SERVER_HOST, bind_port, 'SERVER{}'.format(index))
-    threads = [
-        Thread(target=dht_s.send_forever),
-        Thread(target=dht_s.receive_forever),
-        Thread(target=dht_s.reporter)
-    ]
 
-    for t in threads:
-        t.start()
+def exit_on_sigterm():
+    """收到 SIGTERM 时正常退出, 这样 finally 里的清理可以执行"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    for t in threads:
-        t.join()
 
+def get_worker_coordinator(coordinator, index):
+    return coordinator.for_worker(index) if coordinator else None
 
-def start_multi_server(count=DEFAULT_SERVER_COUNT, origin_bind_port=DEFAULT_SERVER_PORT):
+
+def create_servers(name, bind_port, coordinator=None, ipv6=False, **options):
+    """
+    创建一个爬虫的 server, ipv6 为 True 时再创建一个绑定同一个端口的 IPv6 server
+
+    options 为 DHTServer 的其他参数
+    """
+    dht_s = DHTServer(SERVER_HOST, bind_port, name, coordinator=coordinator, **options)
+    servers = [dht_s]
+    if ipv6:
+        try:
+            servers.append(DHTServer(SERVER_HOST6, bind_port, name + '-6', family=socket.AF_INET6, sibling=dht_s,
+                                     **options))
+        except OSError:
+            dht_s.logger.exception('IPv6 is not available')
+    return servers
+
+
+def close_servers(servers):
+    for dht_s in servers:
+        dht_s.close()
+
+
+def start_server(index=0, bind_port=DEFAULT_SERVER_PORT, coordinator=None, **options):
+    exit_on_sigterm()
+    servers = create_servers('SERVER{}'.format(index), bind_port, get_worker_coordinator(coordinator, index),
+                             **options)
+    # daemon 线程, 主线程退出时不需要等待它们
+    threads = []
+    for dht_s in servers:
+        threads += [
+            Thread(target=dht_s.send_forever, daemon=True),
+            Thread(target=dht_s.receive_forever, daemon=True),
+            Thread(target=dht_s.reporter, daemon=True)
+        ]
+        if dht_s.sample:
+            threads.append(Thread(target=dht_s.sample_forever, daemon=True))
+
+    try:
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+    finally:
+        close_servers(servers)
+
+
+def start_batch_server(index=0, bind_port=DEFAULT_SERVER_PORT, coordinator=None, **options):
+    exit_on_sigterm()
+    servers = create_servers('SERVER{}'.format(index), bind_port, get_worker_coordinator(coordinator, index),
+                             **options)
+    try:
+        # IPv6 server 在另一个线程里运行自己的批量收发循环
+        for dht_s in servers[1:]:
+            Thread(target=dht_s.batch_forever, daemon=True).start()
+        servers[0].batch_forever()
+    finally:
+        close_servers(servers)
+
+
+async def serve_async(index, bind_ports, coordinator=None, **options):
+    """在一个事件循环里驱动多个绑定不同端口的 DHTServer"""
+    loop = asyncio.get_running_loop()
+    servers = []
+    tasks = []
+    try:
+        for i, port in enumerate(bind_ports):
+            # 每个 socket 都是一个单独的爬虫, 在所有爬虫里的序号
+            worker_index = index * len(bind_ports) + i
+            worker_servers = create_servers('SERVER{}-{}'.format(index, i), port,
+                                            get_worker_coordinator(coordinator, worker_index), **options)
+            servers.extend(worker_servers)
+            for dht_s in worker_servers:
+                _, protocol = await loop.create_datagram_endpoint(lambda s=dht_s: DHTProtocol(s),
+                                                                  sock=dht_s.udp_socket)
+                tasks.append(dht_s.send_forever_async(protocol))
+                tasks.append(dht_s.reporter_async())
+                if dht_s.sample:
+                    tasks.append(dht_s.sample_forever_async())
+        await asyncio.gather(*tasks)
+    finally:
+        close_servers(servers)
+
+
+def start_async_server(index=0, bind_ports=(DEFAULT_SERVER_PORT,), coordinator=None, **options):
+    exit_on_sigterm()
+    asyncio.run(serve_async(index, bind_ports, coordinator, **options))
+
+
+def start_multi_server(count=DEFAULT_SERVER_COUNT, origin_bind_port=DEFAULT_SERVER_PORT, mode=DEFAULT_SERVER_MODE,
+                       sockets=DEFAULT_SOCKETS_PER_PROCESS, sample=False, ipv6=False):
+    """
+    启动多个爬虫进程
+
+    :param count: 进程数
+    :param origin_bind_port: 绑定端口的起始位置
+    :param mode: thread, async 或 batch
+    :param sockets: async 模式下每个进程绑定的 socket 数量
+    :param sample: 是否用 sample_infohashes 主动采集
+    :param ipv6: 是否同时爬取 IPv6 的 DHT 网络
+    """
     # signal.signal(signal.SIGINT, handler)
     # signal.signal(signal.SIGTERM, handler)
 
+    # 多个爬虫时在它们之间分配节点, 共享 info_hash 去重
+    workers = count * sockets if mode == 'async' else count
+    coordinator = WorkerCoordinator(workers) if workers > 1 else None
+    options = {'sample': sample, 'ipv6': ipv6}
+
     processes = []
     try:
         for i in range(count):
-            p = Process(target=start_server, args=(i, origin_bind_port + i,))
+            if mode == 'async':
+                ports = tuple(origin_bind_port + i * sockets + j for j in range(sockets))
+                p = Process(target=start_async_server, args=(i, ports, coordinator,), kwargs=options)
+            elif mode == 'batch':
+                p = Process(target=start_batch_server, args=(i, origin_bind_port + i, coordinator,), kwargs=options)
+            else:
+                p = Process(target=start_server, args=(i, origin_bind_port + i, coordinator,), kwargs=options)
             p.start()
             processes.append(p)
 
@@ -1,12 +1,14 @@
-import json
 import logging
+import queue
+import re
 import sqlite3
-import string
+import time
 from datetime import datetime
+from threading import Lock, Thread
 
 import redis
 
-# redis config
+# redis config, 所有集合里存的都是 20 字节的 info_hash
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 # 所有的magnet存在这里
@@ -15,6 +17,35 @@ REDIS_ALL_KEY = 'all-magnet'
 REDIS_USED_KEY = 'used-magnet'
 # 能下载的magnet
 REDIS_AVAIL_KEY = 'magnet'
+# 还没有进行过转换的magnet, 转换时从这里取出
+REDIS_PENDING_KEY = 'pending-magnet'
+# 已经从 all-magnet 和 used-magnet 迁移到 pending-magnet 的标记
+REDIS_PENDING_MIGRATED_KEY = 'pending-magnet-migrated'
+# 缓冲写入: 缓冲了这么多个, 或者距离上次写入超过这么久, 就用一次 pipeline 写入 redis
+REDIS_BUFFER_SIZE = 500
+REDIS_FLUSH_INTERVAL = 1
+# redis 不可用时缓冲最多保留的数量, 超过的丢弃
+REDIS_MAX_BUFFER_SIZE = 100000
+# announce_peer 的 peer 存在 announce-peers:<20 字节 info_hash> 里, 是 compact peer info 的集合
+REDIS_ANNOUNCE_PEERS_PREFIX = b'announce-peers:'
+# peer 很快就会离开, 只保存一小段时间
+REDIS_ANNOUNCE_PEERS_TTL = 10 * 60
+# 最近 announce_peer 过的 info_hash, 有序集合, score 是时间. 转换时先从这里取, 趁 peer 还没有过期
+REDIS_ANNOUNCED_KEY = 'announced-magnet'
+# announced-magnet 最多保存的数量, 超过的丢弃最早的
+REDIS_ANNOUNCED_MAX_SIZE = 100000
+# 加入 all-magnet 时, 新的 magnet 同时加入 pending-magnet
+# KEYS[1]: all-magnet, KEYS[2]: pending-magnet, ARGV: magnets
+ADD_NEW_SCRIPT = '''
+local added = 0
+for _, magnet in ipairs(ARGV) do
+    if redis.call('SADD', KEYS[1], magnet) == 1 then
+        redis.call('SADD', KEYS[2], magnet)
+        added = added + 1
+    end
+end
+return added
+'''
 
 # mysql config
 MYSQL_HOST = '127.0.0.1'
@@ -22,27 +53,231 @@ MYSQL_PORT = 3306
 
 # sqlite3
 SQLITE_DATABASE_NAME = 'magnet.db'
+# 以前按 info_hash 第一位分成 magnet_0 .. magnet_z 的表结构, 只用于迁移旧数据
+CREATE_TABLE_SQL = '''
+    create table {table_name}
+    (
+      id integer not null primary key autoincrement,
+      info_hash blob(20) not null unique,
+      torrent_name varchar(500),
+      content text,
+      create_date datetime(6)
+    );
+    '''
+# 种子表, 文件表按 (torrent_id, idx) 聚集存放, 同一个种子的文件在一起;
+# torrents_fts 是种子名称和文件名的全文索引, rowid 就是 torrents.id, 不保存原文(content='').
+# 种子名称大多是中文, unicode61 分词不能切分中文, 用 trigram 分词可以搜索任意子串;
+# trigram 不能搜索 3 个字符以下的关键词, torrents_bigram 保存 to_bigrams 切好的 2 个字符的词, 用于搜索短关键词
+SCHEMA_SQL = '''
+    create table if not exists torrents
+    (
+      id integer primary key,
+      info_hash blob(20) not null unique,
+      name text,
+      length integer,
+      file_count integer,
+      created_by text,
+      creation_date integer,
+      create_date datetime(6)
+    );
+    create table if not exists files
+    (
+      torrent_id integer not null,
+      idx integer not null,
+      path text,
+      length integer,
+      primary key (torrent_id, idx)
+    ) without rowid;
+    create virtual table if not exists torrents_fts using fts5(name, files, content='', tokenize='trigram');
+    create virtual table if not exists torrents_bigram using fts5(name, files, content='', tokenize='unicode61');
+    '''
+INSERT_TORRENT_SQL = '''
+    insert or ignore into torrents
+    (info_hash, name, length, file_count, created_by, creation_date, create_date)
+    values(?, ?, ?, ?, ?, ?, ?);
+    '''
+INSERT_FILE_SQL = 'insert into files(torrent_id, idx, path, length) values(?, ?, ?, ?);'
+INSERT_FTS_SQL = 'insert into torrents_fts(rowid, name, files) values(?, ?, ?);'
+INSERT_BIGRAM_SQL = 'insert into torrents_bigram(rowid, name, files) values(?, ?, ?);'
+SEARCH_SQL = '''
+    select t.info_hash, t.name, t.length, t.file_count, t.create_date
+    from torrents_fts f join torrents t on t.id = f.rowid
+    where torrents_fts match ? order by f.rowid desc limit ?;
+    '''
+SEARCH_BIGRAM_SQL = '''
+    select t.info_hash, t.name, t.length, t.file_count, t.create_date
+    from torrents_bigram f join torrents t on t.id = f.rowid
+    where torrents_bigram match ? order by f.rowid desc limit ?;
+    '''
+# 两个索引都不能用的关键词(比如带标点的短关键词)只扫描最近的 SEARCH_SCAN_ROWS 个种子的名称
+SEARCH_NAME_SQL = '''
+    select info_hash, name, length, file_count, create_date
+    from torrents where id > (select max(id) from torrents) - ? and name like ? order by id desc limit ?;
+    '''
+# trigram 至少要 3 个字符才能用索引, 更短的关键词用 torrents_bigram
+SEARCH_MIN_LENGTH = 3
+SEARCH_SCAN_ROWS = 100000
+# to_bigrams 只切分字母和数字组成的部分, 和 unicode61 分词的规则一致
+BIGRAM_RUN_PATTERN = re.compile(r'[^\W_]+')
+SEARCH_LIMIT = 20
+GET_FILES_SQL = '''
+    select f.path, f.length from torrents t join files f on f.torrent_id = t.id
+    where t.info_hash = ? order by f.idx;
+    '''
+# 批量写入: 攒够这么多条, 或者距离上次写入超过这么久, 就在一个事务里写入
+SQLITE_BATCH_SIZE = 500
+SQLITE_FLUSH_INTERVAL = 1
+# 等待写入的队列长度, 满了 insert 会阻塞, 不会无限占用内存
+SQLITE_QUEUE_SIZE = 10000
+# sqlite 整数的范围
+SQLITE_MAX_INT = 2 ** 63 - 1
+SQLITE_MIN_INT = -2 ** 63
 
 
 class RedisClient:
-    def __init__(self, host=REDIS_HOST, port=REDIS_PORT):
+    def __init__(self, host=REDIS_HOST, port=REDIS_PORT, buffer_size=REDIS_BUFFER_SIZE,
+                 flush_interval=REDIS_FLUSH_INTERVAL):
         pool = redis.ConnectionPool(host=host, port=port, db=0)
         self.client = redis.Redis(connection_pool=pool)
+        # key -> [magnet, ...], 等待写入的 magnet
+        self.buffer = dict()
+        # info_hash -> [compact peer, ...], 等待写入的 announce_peer
+        self.peer_buffer = dict()
+        self.buffered = 0
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+        self.lock = Lock()
+        self.add_new_script = self.client.register_script(ADD_NEW_SCRIPT)
 
     def add(self, magnet, key=REDIS_ALL_KEY):
-        self.client.sadd(key, magnet)
+        if key == REDIS_ALL_KEY:
+            self.add_new_script(keys=[REDIS_ALL_KEY, REDIS_PENDING_KEY], args=[magnet])
+        else:
+            self.client.sadd(key, magnet)
+
+    def buffer_add(self, magnet, key=REDIS_ALL_KEY):
+        """先放进缓冲, 缓冲满了或者到时间了再批量写入"""
+        with self.lock:
+            self.buffer.setdefault(key, []).append(magnet)
+            self.buffered += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def buffer_add_peer(self, info_hash, peer):
+        """缓冲 announce_peer 的 peer, 和 magnet 一起写入"""
+        with self.lock:
+            self.peer_buffer.setdefault(info_hash, []).append(peer)
+            self.buffered += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if self.buffered and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """把缓冲里的 magnet 用一个 pipeline 写入, 每个 key 一条多成员的 SADD"""
+        with self.lock:
+            buffer, self.buffer = self.buffer, dict()
+            peer_buffer, self.peer_buffer = self.peer_buffer, dict()
+            self.buffered = 0
+            self.last_flush = time.time()
+        if not buffer and not peer_buffer:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for key, magnets in buffer.items():
+            if key == REDIS_ALL_KEY:
+                self.add_new_script(keys=[REDIS_ALL_KEY, REDIS_PENDING_KEY], args=magnets, client=pipe)
+            else:
+                pipe.sadd(key, *magnets)
+        if peer_buffer:
+            now = time.time()
+            for info_hash, peers in peer_buffer.items():
+                key = REDIS_ANNOUNCE_PEERS_PREFIX + info_hash
+                pipe.sadd(key, *peers)
+                pipe.expire(key, REDIS_ANNOUNCE_PEERS_TTL)
+            # 不同版本的 redis-py 的 zadd 参数不一样, 直接用命令
+            args = []
+            for info_hash in peer_buffer:
+                args += (now, info_hash)
+            pipe.execute_command('ZADD', REDIS_ANNOUNCED_KEY, *args)
+            pipe.zremrangebyrank(REDIS_ANNOUNCED_KEY, 0, -REDIS_ANNOUNCED_MAX_SIZE - 1)
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            logging.exception(e)
+            # peer 很快就会过期, 写入失败就不保留了
+            self.restore(buffer)
+
+    def restore(self, buffer):
+        """写入失败时放回缓冲, 下次再写"""
+        with self.lock:
+            for key, magnets in buffer.items():
+                room = REDIS_MAX_BUFFER_SIZE - self.buffered
+                if room <= 0:
+                    break
+                self.buffer.setdefault(key, []).extend(magnets[:room])
+                self.buffered += min(room, len(magnets))
+
+    def close(self):
+        self.flush()
 
     def count(self, key=REDIS_ALL_KEY):
         return self.client.scard(key)
 
-    def get(self, count, keys=REDIS_ALL_KEY):
-        """用于转换magnet"""
-        # keys = (REDIS_ALL_KEY, REDIS_USED_KEY)
-        diff_set = self.client.sdiff(keys)
-        length = len(diff_set)
-        count = count if length > count else length
-        magnets = [diff_set.pop() for _ in range(count)]
-        return magnets
+    def get(self, count, key=REDIS_PENDING_KEY):
+        """用于转换magnet, 从 pending-magnet 里原子地取出最多 count 个"""
+        # SPOP 带 count 参数需要 redis >= 3.2
+        return self.client.execute_command('SPOP', key, count) or []
+
+    def get_announced(self, count):
+        """
+        从 announced-magnet 里原子地取出最多 count 个最近 announce_peer 过的 info_hash, 最新的在前面
+
+        peer 已经过期的丢弃, 已经转换过的跳过, 取出的同时从 pending-magnet 里去掉, 不会再转换一次
+        """
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(REDIS_ANNOUNCED_KEY, '-inf', time.time() - REDIS_ANNOUNCE_PEERS_TTL)
+        pipe.zrevrange(REDIS_ANNOUNCED_KEY, 0, count - 1)
+        pipe.zremrangebyrank(REDIS_ANNOUNCED_KEY, -count, -1)
+        info_hashes = pipe.execute()[1]
+        if not info_hashes:
+            return []
+        pipe = self.client.pipeline(transaction=False)
+        for info_hash in info_hashes:
+            pipe.sismember(REDIS_USED_KEY, info_hash)
+        info_hashes = [info_hash for info_hash, used in zip(info_hashes, pipe.execute()) if not used]
+        if info_hashes:
+            self.client.srem(REDIS_PENDING_KEY, *info_hashes)
+        return info_hashes
+
+    def get_peers(self, info_hashes):
+        """取出每个 info_hash 最近 announce_peer 过的 peer, 返回和 info_hashes 对应的 compact peer 集合的列表"""
+        if not info_hashes:
+            return []
+        pipe = self.client.pipeline(transaction=False)
+        for info_hash in info_hashes:
+            pipe.smembers(REDIS_ANNOUNCE_PEERS_PREFIX + info_hash)
+        return pipe.execute()
+
+    def migrate_pending(self):
+        """
+        只执行一次: 把 all-magnet 里没有在 used-magnet 里的 magnet 加入 pending-magnet
+
+        全部在 redis 服务端完成, 不需要把集合传到 python
+        """
+        if not self.client.setnx(REDIS_PENDING_MIGRATED_KEY, int(time.time())):
+            return 0
+        tmp_key = REDIS_PENDING_KEY + '-tmp'
+        self.client.sdiffstore(tmp_key, [REDIS_ALL_KEY, REDIS_USED_KEY])
+        self.client.sunionstore(REDIS_PENDING_KEY, [REDIS_PENDING_KEY, tmp_key])
+        self.client.delete(tmp_key)
+        return self.count(REDIS_PENDING_KEY)
 
     def diff(self, keys, count):
         diff_set = self.client.sdiff(keys)
@@ -61,72 +296,207 @@ class SqliteClient:
         self.db = db
         # sqlite3.ProgrammingError: SQLite objects created in a thread can only be used in that same thread.
         self.conn = sqlite3.connect(db, check_same_thread=False)
+        # WAL 模式下写入不阻塞读取, 提交时只追加到 WAL 文件, synchronous=normal 时不需要每次提交都 fsync
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('pragma synchronous=normal')
+        self.conn.executescript(SCHEMA_SQL)
 
-    def insert(self, magnet, data):
-        insert_sql = '''
-                insert into {table_name}
-                (magnet, torrent_name, content, create_date)
-                values(?, ?, ?, ?);
-                '''
-        cursor = self.conn.cursor()
-        table_name = 'magnet_{}'.format(magnet[-40].lower())
-        # table_name = 'magnet_{}'.format(magnet[0])
+    def insert(self, info_hash, data):
+        self.insert_many([(info_hash, data)])
+
+    def insert_many(self, items):
+        """
+        在一个事务里写入多个 (info_hash, data), 已经存在的 info_hash 跳过
+
+        整批写入出错时逐条重试, 只跳过出错的那些
+        :return: 写入的种子数
+        """
+        now = datetime.now()
+        rows = [(info_hash, data, now) for info_hash, data in items]
         try:
-            params = (magnet, data.get('name', None), json.dumps(data), datetime.now(),)
-            cursor.execute(insert_sql.format(table_name=table_name), params)
-            self.conn.commit()
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            cursor.close()
-            self.conn.commit()
+            with self.conn:
+                return insert_torrents(self.conn.cursor(), rows)
+        except Exception as e:
+            logging.warning('batch insert failed, retry one by one: {!r}'.format(e))
+        count = 0
+        for row in rows:
+            try:
+                with self.conn:
+                    count += insert_torrents(self.conn.cursor(), [row])
+            except Exception as e:
+                logging.warning('skip {!r}: {!r}'.format(row[0], e))
+        return count
+
+    def search(self, keyword, limit=SEARCH_LIMIT):
+        """
+        按种子名称和文件名搜索, 新的在前面
+
+        :return: [(info_hash, name, length, file_count, create_date), ...]
+        """
+        if len(keyword) >= SEARCH_MIN_LENGTH:
+            # 整个关键词作为一个短语, 不解析 FTS5 的查询语法
+            return self.conn.execute(SEARCH_SQL, ('"{}"'.format(keyword.replace('"', '""')), limit)).fetchall()
+        if keyword and BIGRAM_RUN_PATTERN.fullmatch(keyword):
+            # 2 个字符的关键词就是一个词, 1 个字符的用前缀查询
+            query = '"{}"'.format(keyword) if len(keyword) == 2 else '"{}"*'.format(keyword)
+            return self.conn.execute(SEARCH_BIGRAM_SQL, (query, limit)).fetchall()
+        return self.conn.execute(SEARCH_NAME_SQL, (SEARCH_SCAN_ROWS, '%{}%'.format(keyword), limit)).fetchall()
+
+    def exists(self, info_hashes):
+        """info_hashes 里已经保存过的, 返回 set"""
+        info_hashes = list(info_hashes)
+        found = set()
+        for i in range(0, len(info_hashes), SQLITE_BATCH_SIZE):
+            batch = info_hashes[i:i + SQLITE_BATCH_SIZE]
+            sql = 'select info_hash from torrents where info_hash in ({})'.format(','.join('?' * len(batch)))
+            found.update(row[0] for row in self.conn.execute(sql, batch))
+        return found
+
+    def get_files(self, info_hash):
+        """种子里的文件 [(path, length), ...]"""
+        return self.conn.execute(GET_FILES_SQL, (info_hash,)).fetchall()
+
+    def close(self):
+        self.conn.close()
 
     def count(self):
-        pass
+        return self.conn.execute('select count(*) from torrents').fetchone()[0]
 
 
-def create_tables(db):
-    create_sql = '''
-    create table {table_name}
-    (
-      id integer not null primary key autoincrement,
-      magnet varchar(30) not null unique,
-      torrent_name varchar(500),
-      content text,
-      create_date datetime(6)
-    );
-    '''
-    drop_sql = '''
-    drop table {table_name};
-    '''
-    table_names = ['magnet_' + i for i in string.digits + string.ascii_lowercase]
-    exec_tables = []
+class SqliteWriter:
+    """
+    写入 sqlite 的后台线程
+
+    insert 只是放进队列, 由唯一的写入线程攒成一批后用 SqliteClient.insert_many 在一个事务里写入,
+    所有使用者共用这一个连接
+    """
+
+    def __init__(self, db, batch_size=SQLITE_BATCH_SIZE, flush_interval=SQLITE_FLUSH_INTERVAL,
+                 queue_size=SQLITE_QUEUE_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.written = 0
+
+    def start(self):
+        self.thread = Thread(target=self.write_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def insert(self, info_hash, data):
+        self.queue.put((info_hash, data))
 
+    def write_forever(self):
+        client = SqliteClient(self.db)
+        batch = []
+        last_flush = time.time()
+        try:
+            while True:
+                timeout = max(0, last_flush + self.flush_interval - time.time()) if batch else None
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = ()
+                # None 表示退出
+                if item is None:
+                    break
+                if item:
+                    batch.append(item)
+                if len(batch) >= self.batch_size or (batch and time.time() - last_flush >= self.flush_interval):
+                    self.write(client, batch)
+                    batch = []
+                    last_flush = time.time()
+        finally:
+            if batch:
+                self.write(client, batch)
+            client.close()
+
+    def write(self, client, batch):
+        try:
+            self.written += client.insert_many(batch)
+        except Exception as e:
+            # 写入线程不能退出, 否则队列满了之后 insert 会一直阻塞
+            logging.exception(e)
+
+    def close(self):
+        """写入队列里剩下的数据后退出"""
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+def to_integer(value):
+    """sqlite 能保存的整数, 不是整数或者超出范围的返回 None"""
+    if isinstance(value, bool) or not isinstance(value, int) or not SQLITE_MIN_INT <= value <= SQLITE_MAX_INT:
+        return None
+    return value
+
+
+def to_text(value):
+    """名称和路径统一保存为 str"""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return str(value)
+
+
+def to_bigrams(text):
+    """
+    把文本里字母和数字组成的每一段切成 2 个字符的词, 用空格连接, 交给 torrents_bigram 的 unicode61 分词
+
+    每一段的最后一个字符也单独作为一个词, 这样每个字符都是某个词的开头, 1 个字符的关键词可以用前缀查询.
+    只用于判断是否包含, 重复的词只保留一个
+    """
+    tokens = set()
+    for run in BIGRAM_RUN_PATTERN.findall(text.lower()):
+        tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+        tokens.add(run[-1])
+    return ' '.join(tokens)
+
+
+def insert_torrents(cursor, items):
+    """
+    在当前的事务里写入 [(info_hash, data, create_date), ...], 已经存在的 info_hash 跳过
+
+    data 是 TorrentParser.get_torrent_info 的结果
+    :return: 写入的种子数
+    """
+    file_rows = []
+    fts_rows = []
+    bigram_rows = []
+    for info_hash, data, create_date in items:
+        # 种子里的值可能是任意的 bencode, 先整理成能写入的类型
+        name = to_text(data.get('name'))
+        files = [(to_text(file.get('name')), to_integer(file.get('length')))
+                 for file in data.get('files') or [] if isinstance(file, dict)]
+        length = min(sum(file_length or 0 for _, file_length in files), SQLITE_MAX_INT)
+        params = (info_hash, name, length, len(files), to_text(data.get('created by')),
+                  to_integer(data.get('creation date')), create_date,)
+        cursor.execute(INSERT_TORRENT_SQL, params)
+        if not cursor.rowcount:
+            continue
+        torrent_id = cursor.lastrowid
+        file_rows.extend((torrent_id, i, path, file_length) for i, (path, file_length) in enumerate(files))
+        paths = '\n'.join(path or '' for path, _ in files)
+        fts_rows.append((torrent_id, name or '', paths))
+        bigram_rows.append((torrent_id, to_bigrams(name or ''), to_bigrams(paths)))
+    cursor.executemany(INSERT_FILE_SQL, file_rows)
+    cursor.executemany(INSERT_FTS_SQL, fts_rows)
+    cursor.executemany(INSERT_BIGRAM_SQL, bigram_rows)
+    return len(fts_rows)
+
+
+def create_tables(db):
     conn = sqlite3.connect(db)
-    cursor = conn.cursor()
     try:
-        for name in table_names:
-            try:
-                cursor.execute(create_sql.format(table_name=name))
-                exec_tables.append(name)
-                conn.commit()
-                print('table {} created successful'.format(name))
-            except sqlite3.OperationalError as e:
-                # logging.exception(e)
-                if 'already exists' in str(e):
-                    print(e)
-                    continue
-                else:
-                    raise Exception
+        conn.executescript(SCHEMA_SQL)
+        print('database {} created successful'.format(db))
     except sqlite3.OperationalError as e:
         logging.exception(e)
-    except KeyboardInterrupt:
-        for name in exec_tables:
-            cursor.execute(drop_sql.format(table_name=name))
-            conn.commit()
     finally:
-        cursor.close()
-        conn.commit()
         conn.close()
 
 
@@ -0,0 +1,150 @@
+"""
+爬虫的 info_hash 去重
+
+用两代轮换的布隆过滤器代替无限增长的 set: 内存固定, 有很小的误判率(把新的 info_hash 当成见过),
+不会漏判. 当前一代装满后丢弃旧的一代, 所以很久以前见过的 info_hash 会被再次当成新的.
+多个爬虫进程可以用 SharedRotatingBloomFilter 共用同一个过滤器.
+"""
+import hashlib
+import math
+from multiprocessing import Array, RawArray
+
+# 布隆过滤器占用的内存上限, 两代合计
+BLOOM_MAX_BYTES = 16 * 1024 * 1024
+# 每一代装满时的误判率
+BLOOM_ERROR_RATE = 0.001
+LN2 = math.log(2)
+
+
+class BloomFilter:
+    def __init__(self, num_bytes, error_rate=BLOOM_ERROR_RATE, bits=None):
+        """
+
+        :param num_bytes: 位数组占用的字节数
+        :param error_rate: 装满 capacity 个元素时的误判率
+        :param bits: 使用已有的位数组(比如共享内存), 默认新建一个
+        """
+        self.bits = bits if bits is not None else bytearray(num_bytes)
+        self.num_bits = num_bytes * 8
+        # 根据位数和误判率算出容量和哈希函数个数
+        self.capacity = int(-self.num_bits * LN2 * LN2 / math.log(error_rate))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * LN2))
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def positions(self, key):
+        """
+        info_hash 本身就是 sha1, 直接切出两个 64 位整数做双重哈希;
+        其他长度的 key 先做一次 sha1
+        """
+        if len(key) != 20:
+            key = hashlib.sha1(key).digest()
+        h1 = int.from_bytes(key[:8], 'big')
+        h2 = int.from_bytes(key[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+    def add(self, key):
+        """加入 key, 之前不存在返回 True"""
+        new = False
+        for p in self.positions(key):
+            mask = 1 << (p & 7)
+            if not self.bits[p >> 3] & mask:
+                self.bits[p >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+
+class RotatingBloomFilter:
+    """两代布隆过滤器, 两代都查, 只往当前一代里加, 当前一代满了就替换掉旧的一代"""
+
+    def __init__(self, max_bytes=BLOOM_MAX_BYTES, error_rate=BLOOM_ERROR_RATE):
+        self.generation_bytes = max_bytes // 2
+        self.error_rate = error_rate
+        self.current = BloomFilter(self.generation_bytes, error_rate)
+        self.previous = None
+
+    def __len__(self):
+        return len(self.current) + (len(self.previous) if self.previous else 0)
+
+    def __contains__(self, key):
+        return key in self.current or (self.previous is not None and key in self.previous)
+
+    def add(self, key):
+        """加入 key, 两代里都不存在返回 True"""
+        if self.previous is not None and key in self.previous:
+            # 放进当前一代, 这样常见的 info_hash 轮换后也不会被当成新的
+            self.current.add(key)
+            return False
+        if not self.current.add(key):
+            return False
+        if self.current.is_full():
+            self.rotate()
+        return True
+
+    def rotate(self):
+        self.previous = self.current
+        self.current = BloomFilter(self.generation_bytes, self.error_rate)
+
+
+class SharedRotatingBloomFilter:
+    """
+    多个进程共用的两代布隆过滤器
+
+    两代的位数组放在同一块共享内存里, 当前是哪一代和当前一代的数量放在带锁的共享数组里,
+    创建后作为参数传给子进程
+    """
+
+    def __init__(self, max_bytes=BLOOM_MAX_BYTES, error_rate=BLOOM_ERROR_RATE):
+        self.generation_bytes = max_bytes // 2
+        self.error_rate = error_rate
+        self.array = RawArray('B', self.generation_bytes * 2)
+        # [当前一代的下标, 当前一代的数量]
+        self.state = Array('q', 2)
+        self.generations = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['generations'] = None
+        return state
+
+    def get_generations(self):
+        if self.generations is None:
+            view = memoryview(self.array).cast('B')
+            size = self.generation_bytes
+            self.generations = [BloomFilter(size, self.error_rate, view[i * size:(i + 1) * size]) for i in range(2)]
+        return self.generations
+
+    def __len__(self):
+        return self.state[1]
+
+    def __contains__(self, key):
+        return any(key in generation for generation in self.get_generations())
+
+    def add(self, key):
+        """加入 key, 两代里都不存在返回 True"""
+        generations = self.get_generations()
+        with self.state.get_lock():
+            index = self.state[0]
+            current, previous = generations[index], generations[1 - index]
+            if key in previous:
+                current.add(key)
+                return False
+            if not current.add(key):
+                return False
+            self.state[1] += 1
+            if self.state[1] >= current.capacity:
+                # 清空旧的一代, 作为新的当前一代
+                previous.bits[:] = bytes(self.generation_bytes)
+                self.state[0] = 1 - index
+                self.state[1] = 0
+            return True
@@ -0,0 +1,149 @@
+"""
+把目录里的 .torrent 文件批量导入数据库
+
+用于 aria2 下载了种子但是没有写入数据库的情况(比如转换中断过). 已经在数据库里的 info_hash 跳过,
+其余的在进程池里解析, 解析结果交给 SqliteWriter 批量写入. 写入是按批提交的, 中断后再次运行会跳过已经写入的部分.
+"""
+import os
+import signal
+import time
+from multiprocessing import Pool
+
+from magnet_crawler.database import SqliteClient, SqliteWriter, SQLITE_BATCH_SIZE
+from magnet_crawler.parse_torrent import TorrentParser
+from magnet_crawler.utils import get_logger
+
+# 每次发给解析进程的文件数
+IMPORT_CHUNK_SIZE = 64
+# 输出进度的间隔
+IMPORT_REPORT_INTERVAL = 5
+TORRENT_SUFFIX = '.torrent'
+
+
+def get_info_hash(filename):
+    """aria2 保存的种子文件名是 16 进制的 info_hash, 其他文件名返回 None"""
+    name = filename[:-len(TORRENT_SUFFIX)]
+    if len(name) != 40:
+        return None
+    try:
+        return bytes.fromhex(name)
+    except ValueError:
+        return None
+
+
+def scan_torrents(directory):
+    """目录里的种子文件, yield (info_hash, path), 文件名不是 info_hash 的 info_hash 为 None"""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(TORRENT_SUFFIX) and entry.is_file():
+                yield get_info_hash(entry.name), entry.path
+
+
+def find_pending(directory, sqlite):
+    """
+    还没有导入的种子文件
+
+    :return: (需要解析的文件路径列表, 扫描到的文件数)
+    """
+    pending = []
+    scanned = 0
+    batch = []
+
+    def check(batch):
+        found = sqlite.exists(info_hash for info_hash, _ in batch)
+        pending.extend(path for info_hash, path in batch if info_hash not in found)
+
+    for info_hash, path in scan_torrents(directory):
+        scanned += 1
+        if info_hash is None:
+            # 只有解析之后才知道 info_hash, 写入时重复的会被忽略
+            pending.append(path)
+            continue
+        batch.append((info_hash, path))
+        if len(batch) >= SQLITE_BATCH_SIZE:
+            check(batch)
+            batch = []
+    if batch:
+        check(batch)
+    return pending, scanned
+
+
+def init_worker():
+    # Ctrl-C 只由主进程处理, 解析进程由主进程结束
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def parse_torrent_file(path):
+    """
+    在解析进程里运行
+
+    :return: (path, info_hash, data), 解析失败时 info_hash 为 None, data 为错误信息
+    """
+    try:
+        parser = TorrentParser(path)
+        if parser.info_hash is None:
+            return path, None, 'no info dict'
+        return path, parser.info_hash, parser.get_torrent_info()
+    except Exception as e:
+        return path, None, repr(e)
+
+
+class TorrentImporter:
+    def __init__(self, db, directory, workers=None, **kwargs):
+        self.db = db
+        self.directory = directory
+        self.workers = workers if workers else os.cpu_count()
+        self.logger = get_logger(kwargs.get('logger_name', 'IMPORT'))
+        self.total = 0
+        self.parsed = 0
+        self.failed = 0
+        self.started_at = None
+        self.writer = None
+
+    def run(self):
+        sqlite = SqliteClient(self.db)
+        try:
+            pending, scanned = find_pending(self.directory, sqlite)
+        finally:
+            sqlite.close()
+        self.total = len(pending)
+        self.logger.info('扫描到{}个种子文件, 其中{}个已经导入, 需要导入{}个'.format(
+            scanned, scanned - self.total, self.total))
+        if not pending:
+            return
+
+        self.writer = SqliteWriter(self.db).start()
+        pool = Pool(self.workers, initializer=init_worker)
+        self.started_at = time.time()
+        last_report = self.started_at
+        try:
+            for path, info_hash, data in pool.imap_unordered(parse_torrent_file, pending, IMPORT_CHUNK_SIZE):
+                if info_hash is None:
+                    self.failed += 1
+                    self.logger.warning('解析失败 {}: {}'.format(path, data))
+                else:
+                    self.parsed += 1
+                    self.writer.insert(info_hash, data)
+                if time.time() - last_report >= IMPORT_REPORT_INTERVAL:
+                    self.report()
+                    last_report = time.time()
+        except KeyboardInterrupt:
+            self.logger.warning('导入中断, 再次运行会从没有导入的文件继续')
+        finally:
+            pool.terminate()
+            pool.join()
+            # 写入已经解析好的部分
+            self.writer.close()
+            self.report()
+
+    def report(self):
+        done = self.parsed + self.failed
+        elapsed = time.time() - self.started_at
+        speed = done / elapsed if elapsed else 0
+        remaining = (self.total - done) / speed if speed else 0
+        self.logger.info('进度 {}/{} ({:.1%}), 成功{}个, 失败{}个, 已写入{}个, {:.0f}个/秒, 预计还需要{:.0f}秒'.format(
+            done, self.total, done / self.total, self.parsed, self.failed, self.writer.written, speed, remaining))
+
+
+def import_torrents(db, directory, workers=None):
+    TorrentImporter(db, directory, workers).run()
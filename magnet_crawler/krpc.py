@@ -0,0 +1,217 @@
+"""
+KRPC 发送信息的编码
+
+所有发出去的信息都是固定结构的 bencode 字典, 这里把不变的部分预先编码成 bytes 模板,
+发送时只需把 tid, id, target 等拼接到固定位置, 不再构造字典和调用 bencode.
+
+bencode 字典的 key 按字典序排列, 模板也要保持这个顺序.
+"""
+import hashlib
+import os
+import time
+
+# 随机池每次从 os.urandom 取出的字节数
+RANDOM_POOL_SIZE = 64 * 1024
+# 我们发出请求时使用的 transaction id 长度
+TID_LENGTH = 4
+# node id, info_hash 的长度
+ID_LENGTH = 20
+
+# announce_peer 用的 token 长度
+TOKEN_LENGTH = 4
+# token 的密钥更换间隔, 上一个密钥生成的 token 仍然有效
+TOKEN_ROTATE_TIME = 5 * 60
+# 回复时伪装成离目标更近的节点, 取目标 id 的前多少个字节
+NEIGHBOR_PREFIX_LENGTH = 15
+
+# 请求: d1:ad2:id20:<id>...e1:q<method>1:t4:<tid>1:y1:qe
+QUERY_PREFIX = b'd1:ad2:id20:'
+QUERY_SUFFIX = b'1:y1:qe'
+FIND_NODE_TARGET = b'6:target20:'
+FIND_NODE_METHOD = b'e1:q9:find_node1:t4:'
+PING_METHOD = b'e1:q4:ping1:t4:'
+SAMPLE_INFOHASHES_METHOD = b'e1:q17:sample_infohashes1:t4:'
+GET_PEERS_INFO_HASH = b'9:info_hash20:'
+GET_PEERS_METHOD = b'e1:q9:get_peers1:t4:'
+# 回复: d1:rd2:id20:<id>...e1:t<len>:<tid>1:y1:re
+RESPONSE_PREFIX = b'd1:rd2:id20:'
+RESPONSE_TID = b'e1:t'
+RESPONSE_SUFFIX = b'1:y1:re'
+NODES_KEY = b'5:nodes'
+NODES6_KEY = b'6:nodes6'
+TOKEN_KEY = b'5:token'
+# 错误: d1:eli<code>e<len>:<message>e1:t<len>:<tid>1:y1:ee
+ERROR_PREFIX = b'd1:eli'
+ERROR_TID = b'e1:t'
+ERROR_SUFFIX = b'1:y1:ee'
+# 错误码
+ERROR_GENERIC = 201
+ERROR_PROTOCOL = 203
+
+
+class RandomPool:
+    """从一次 os.urandom 里切出随机 id, 避免每个字节都调用一次 random.choice"""
+
+    def __init__(self, size=RANDOM_POOL_SIZE):
+        self.size = size
+        self.buffer = b''
+        self.offset = 0
+
+    def get(self, length):
+        end = self.offset + length
+        if end > len(self.buffer):
+            self.buffer = os.urandom(max(self.size, length))
+            self.offset, end = 0, length
+        data = self.buffer[self.offset:end]
+        self.offset = end
+        return data
+
+
+_random_pool = RandomPool()
+
+
+def random_bytes(length):
+    """从随机池取出 length 个随机字节"""
+    return _random_pool.get(length)
+
+
+def random_tid():
+    return _random_pool.get(TID_LENGTH)
+
+
+def random_id():
+    return _random_pool.get(ID_LENGTH)
+
+
+def is_id(value):
+    """是否是 20 字节的 node id 或 info_hash, 外部发来的值可能是任意类型和长度"""
+    return isinstance(value, bytes) and len(value) == ID_LENGTH
+
+
+def get_neighbor_id(target, nid):
+    """和 target 有相同前缀的 id, 让对方认为我们离 target 很近, 从而把更多相关请求发给我们"""
+    return target[:NEIGHBOR_PREFIX_LENGTH] + nid[NEIGHBOR_PREFIX_LENGTH:]
+
+
+class TokenManager:
+    """
+    生成和校验 announce_peer 需要的 token
+
+    token 是 sha1(secret + ip) 的前几个字节, secret 定期更换, 上一个 secret 生成的 token 也认为有效
+    """
+
+    def __init__(self, rotate_time=TOKEN_ROTATE_TIME):
+        self.rotate_time = rotate_time
+        self.secrets = (os.urandom(ID_LENGTH), os.urandom(ID_LENGTH))
+        self.rotated_at = time.time()
+
+    def rotate(self):
+        now = time.time()
+        if now - self.rotated_at > self.rotate_time:
+            self.secrets = (os.urandom(ID_LENGTH), self.secrets[0])
+            self.rotated_at = now
+
+    @staticmethod
+    def make_token(secret, ip):
+        return hashlib.sha1(secret + ip.encode()).digest()[:TOKEN_LENGTH]
+
+    def get(self, ip):
+        self.rotate()
+        return self.make_token(self.secrets[0], ip)
+
+    def check(self, token, ip):
+        self.rotate()
+        return any(token == self.make_token(secret, ip) for secret in self.secrets)
+
+
+def encode_string(data):
+    """bencode 一个 bytes"""
+    return b'%d:%s' % (len(data), data)
+
+
+def encode_find_node(tid, nid, target):
+    """
+    find_node 请求
+
+    d1:ad2:id20:<nid>6:target20:<target>e1:q9:find_node1:t4:<tid>1:y1:qe
+    """
+    return b''.join((QUERY_PREFIX, nid, FIND_NODE_TARGET, target, FIND_NODE_METHOD, tid, QUERY_SUFFIX))
+
+
+def encode_get_peers(tid, nid, info_hash):
+    """
+    get_peers 请求
+
+    d1:ad2:id20:<nid>9:info_hash20:<info_hash>e1:q9:get_peers1:t4:<tid>1:y1:qe
+    """
+    return b''.join((QUERY_PREFIX, nid, GET_PEERS_INFO_HASH, info_hash, GET_PEERS_METHOD, tid, QUERY_SUFFIX))
+
+
+def encode_sample_infohashes(tid, nid, target):
+    """
+    BEP 51 sample_infohashes 请求
+
+    d1:ad2:id20:<nid>6:target20:<target>e1:q17:sample_infohashes1:t4:<tid>1:y1:qe
+    """
+    return b''.join((QUERY_PREFIX, nid, FIND_NODE_TARGET, target, SAMPLE_INFOHASHES_METHOD, tid, QUERY_SUFFIX))
+
+
+def encode_ping(tid, nid):
+    """
+    ping 请求
+
+    d1:ad2:id20:<nid>e1:q4:ping1:t4:<tid>1:y1:qe
+    """
+    return b''.join((QUERY_PREFIX, nid, PING_METHOD, tid, QUERY_SUFFIX))
+
+
+def encode_ping_response(tid, nid):
+    """
+    ping 的回复, announce_peer 的回复也是同样的结构
+
+    d1:rd2:id20:<nid>e1:t<len>:<tid>1:y1:re
+    """
+    return b''.join((RESPONSE_PREFIX, nid, RESPONSE_TID, encode_string(tid), RESPONSE_SUFFIX))
+
+
+encode_announce_peer_response = encode_ping_response
+
+
+def encode_nodes(nodes, nodes6):
+    """回复里的 nodes 和 nodes6, 为 None 的不编码"""
+    parts = []
+    if nodes is not None:
+        parts += (NODES_KEY, encode_string(nodes))
+    if nodes6 is not None:
+        parts += (NODES6_KEY, encode_string(nodes6))
+    return b''.join(parts)
+
+
+def encode_find_node_response(tid, nid, nodes, nodes6=None):
+    """
+    find_node 的回复, IPv6 的节点放在 nodes6 里(BEP 32)
+
+    d1:rd2:id20:<nid>5:nodes<len>:<nodes>6:nodes6<len>:<nodes6>e1:t<len>:<tid>1:y1:re
+    """
+    return b''.join((RESPONSE_PREFIX, nid, encode_nodes(nodes, nodes6),
+                     RESPONSE_TID, encode_string(tid), RESPONSE_SUFFIX))
+
+
+def encode_get_peers_response(tid, nid, nodes, token, nodes6=None):
+    """
+    get_peers 的回复, 只回复 nodes 不回复 values
+
+    d1:rd2:id20:<nid>5:nodes<len>:<nodes>6:nodes6<len>:<nodes6>5:token<len>:<token>e1:t<len>:<tid>1:y1:re
+    """
+    return b''.join((RESPONSE_PREFIX, nid, encode_nodes(nodes, nodes6), TOKEN_KEY, encode_string(token),
+                     RESPONSE_TID, encode_string(tid), RESPONSE_SUFFIX))
+
+
+def encode_error(tid, code, message):
+    """
+    错误信息
+
+    d1:eli<code>e<len>:<message>e1:t<len>:<tid>1:y1:ee
+    """
+    return b''.join((ERROR_PREFIX, b'%d' % code, b'e', encode_string(message),
+                     ERROR_TID, encode_string(tid), ERROR_SUFFIX))
@@ -3,13 +3,17 @@ import os
 import tempfile
 import time
 import xmlrpc.client
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock, local
 
 import websocket
 
-from magnet_crawler.database import RedisClient, REDIS_USED_KEY, REDIS_AVAIL_KEY, SqliteClient, SQLITE_DATABASE_NAME
+from magnet_crawler.database import RedisClient, REDIS_USED_KEY, REDIS_AVAIL_KEY, REDIS_PENDING_KEY, SqliteWriter, \
+    SQLITE_DATABASE_NAME
 from magnet_crawler.parse_torrent import TorrentParser
-from magnet_crawler.utils import get_logger
+from magnet_crawler.segments import SegmentStore
+from magnet_crawler.state import DownloadStateStore, STATUS_START, STATUS_COMPLETE, STATUS_ERROR
+from magnet_crawler.utils import get_logger, info_hash_to_magnet
 
 RPC_SERVER = "http://localhost:6800/rpc"
 RPC_WEBSOCKET = "ws://localhost:6800/jsonrpc"
@@ -20,12 +24,32 @@ BT_STOP_TIMEOUT = 600
 MAX_DOWNLOADS = 32
 # aria2 下载路径
 DIR_PATH = os.path.abspath('./torrents')
-# 从 redis 每次取出 magnet 的数量
+# 从 redis 每次取出 magnet 的数量, 也是一次 system.multicall 最多加入的下载数
 FETCH_MAGNET_COUNT = 32
-# 完成一轮下载的等待时间
-WAITING_NEXT_TIME = 120
-# 每次投入下载的等待时间
-SINGLE_DOWNLOAD_WAIT_TIME = 10
+# 除了正在下载的, 在 aria2 里排队等待的数量, 有下载完成时 aria2 可以马上开始下一个
+MAX_WAITING_DOWNLOADS = 8
+# 没有空位或者没有 magnet 时, 最多等待这么久再查询一次 aria2; 收到下载完成的通知时马上查询
+DISPATCH_INTERVAL = 5
+# 表示下载结束的 aria2 通知
+DOWNLOAD_FINISHED_METHODS = ('aria2.onDownloadComplete', 'aria2.onDownloadError', 'aria2.onDownloadStop')
+# 处理通知(解析种子, 写入数据库)的线程数, 同一个 gid 的通知总是由同一个线程按顺序处理
+NOTIFICATION_WORKERS = 4
+# 还没有和 info_hash 关联的 gid 的通知先放着, 超过这个时间还没有关联再向 aria2 查询
+DEFER_TIME = 2
+# 检查放着的通知的间隔
+DEFER_CHECK_INTERVAL = 0.5
+# 向 aria2 查询 gid 失败后重试的次数, 第 n 次重试等待 DEFER_TIME * 2 ** n 秒
+RESOLVE_MAX_RETRIES = 5
+# 下载状态的快照, 重启后用于和 aria2 里的下载任务核对
+STATE_PATH = os.path.abspath('./aria2-state.dat')
+# 保存下载状态快照和清理过期状态的间隔
+STATE_SAVE_INTERVAL = 60
+# 核对时 aria2 里的下载状态对应的通知, 还在下载的不需要处理
+RECONCILE_METHODS = {
+    'complete': 'aria2.onDownloadComplete',
+    'error': 'aria2.onDownloadError',
+    'removed': 'aria2.onDownloadStop',
+}
 
 
 def magnet_to_torrent(magnet):
@@ -58,20 +82,42 @@ def magnet_to_torrent(magnet):
 
 class Aria2MagnetConverter:
     def __init__(self, server, secret=None, **kwargs):
-        self.client = xmlrpc.client.ServerProxy(server)
+        self.server = server
+        # ServerProxy 不能在多个线程里同时使用, 每个线程一个
+        self.local = local()
         self.secret = secret
         self.redis_client = RedisClient()
         self.logger = get_logger(kwargs.get('logger_name', 'ARIA2'))
-        self.download_info = dict({'all': dict(),
-                                   'start': dict(),
-                                   'complete': dict(),
-                                   'error': dict(),
-                                   })
-        self.sqlite = SqliteClient(SQLITE_DATABASE_NAME)
+        # 下载中的 gid -> info_hash, 结束的只保留计数
+        self.states = DownloadStateStore()
+        self.state_path = kwargs.get('state_path', STATE_PATH)
+        # 解析好的种子交给写入线程批量写入
+        self.sqlite = SqliteWriter(SQLITE_DATABASE_NAME).start()
+        # aria2 下载的种子文件保存到段文件之后删除
+        self.store = SegmentStore()
+        # 收到下载结束的通知时设置, 让 magnet_to_torrent_forever 马上补充下载
+        self.slot_freed = Event()
+        # gid -> (查询的时间, [method, ...], 查询失败的次数), 还没有和 info_hash 关联的 gid 收到的通知
+        self.deferred = dict()
+        self.lock = Lock()
+        # 每个线程一个队列, 同一个 gid 的通知不会同时处理, 不会出现 Start 在 Complete 之后处理
+        self.executors = [ThreadPoolExecutor(1) for _ in range(NOTIFICATION_WORKERS)]
         if not os.path.exists(DIR_PATH):
             os.mkdir(DIR_PATH)
 
-    def magnet_to_torrent(self, magnet, dir_path=None, **kwargs):
+    @property
+    def client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = xmlrpc.client.ServerProxy(self.server)
+        return client
+
+    def rpc_params(self, *params):
+        """有 secret 时放在参数的最前面"""
+        return [self.secret, *params] if self.secret else list(params)
+
+    @staticmethod
+    def get_download_options(dir_path=None, **kwargs):
         # TODO: 从github拉取tracker
         ops = {
             'bt-metadata-only': 'true',  # 只下载种子
@@ -82,6 +128,10 @@ class Aria2MagnetConverter:
             ops.update(dir=dir_path)
         if kwargs:
             ops.update(kwargs)
+        return ops
+
+    def magnet_to_torrent(self, magnet, dir_path=None, **kwargs):
+        ops = self.get_download_options(dir_path, **kwargs)
         r = None
         try:
             r = self.client.aria2.addUri(self.secret, [magnet], ops)
@@ -91,10 +141,61 @@ class Aria2MagnetConverter:
 
         return r
 
+    def magnets_to_torrents(self, magnets, dir_path=None, **kwargs):
+        """
+        用一次 system.multicall 加入多个下载
+
+        :return: 和 magnets 对应的 gid 列表, 没有加入成功的为 None
+        """
+        ops = self.get_download_options(dir_path, **kwargs)
+        calls = [{'methodName': 'aria2.addUri', 'params': self.rpc_params([magnet], ops)} for magnet in magnets]
+        try:
+            results = self.client.system.multicall(calls)
+        except Exception:
+            self.logger.exception(Exception)
+            return [None] * len(magnets)
+        # 成功的结果是 [gid], 失败的是 {'faultCode': ..., 'faultString': ...}
+        return [r[0] if isinstance(r, list) and r else None for r in results]
+
+    def get_free_slots(self):
+        """aria2 还能加入的下载数: 最大下载数和排队数减去正在下载和等待中的数量, 查询失败返回 0"""
+        try:
+            stat = self.client.aria2.getGlobalStat(*self.rpc_params())
+        except Exception:
+            self.logger.exception(Exception)
+            return 0
+        used = int(stat.get('numActive', 0)) + int(stat.get('numWaiting', 0))
+        return MAX_DOWNLOADS + MAX_WAITING_DOWNLOADS - used
+
+    def dispatch(self):
+        """
+        按 aria2 的空位数从 redis 取出 magnet 并加入下载
+
+        :return: 加入的下载数
+        """
+        free = self.get_free_slots()
+        if free <= 0:
+            return 0
+        # redis 里存的是 20 字节的 info_hash, 发给 aria2 时才转为 magnet
+        info_hashes = self.get_magnets(min(free, FETCH_MAGNET_COUNT))
+        if not info_hashes:
+            return 0
+        gids = self.magnets_to_torrents([info_hash_to_magnet(info_hash) for info_hash in info_hashes], DIR_PATH)
+        added = 0
+        for info_hash, gid in zip(info_hashes, gids):
+            if not gid:
+                # 没有成功加入 aria2, 放回去下次再取
+                self.save_magnet(info_hash, REDIS_PENDING_KEY)
+                continue
+            self.logger.info('sending  <{}>  <gid, {}>'.format(info_hash_to_magnet(info_hash), gid))
+            self.save_magnet(info_hash, REDIS_USED_KEY)
+            self.link(gid, info_hash)
+            added += 1
+        return added
+
     def magnet_to_torrent_forever(self):
         self.logger.warning(
             'set max-download={}, start to download torrent and store to database...'.format(MAX_DOWNLOADS))
-        # TODO：查询当前下载数量，然后再投放下载任务
         global_ops = {
             'max-concurrent-downloads': str(MAX_DOWNLOADS),
         }
@@ -108,14 +209,59 @@ class Aria2MagnetConverter:
         except Exception:
             self.logger.exception(Exception)
 
+        migrated = self.redis_client.migrate_pending()
+        if migrated:
+            self.logger.warning('migrated {} magnets to {}'.format(migrated, REDIS_PENDING_KEY))
+        self.reconcile()
+
+        while True:
+            # 先清除再查询, 查询之后才完成的下载会让下面的 wait 马上返回
+            self.slot_freed.clear()
+            if self.dispatch() < FETCH_MAGNET_COUNT:
+                # 没有空位或者没有 magnet 了, 等到有下载结束
+                self.slot_freed.wait(DISPATCH_INTERVAL)
+
+    def reconcile(self):
+        """
+        重启后核对快照里还在下载的任务: 还在 aria2 里下载的继续等待通知,
+        停止期间已经结束的按对应的通知处理, aria2 里已经没有的(比如 aria2 也重启了)放回去重新下载
+        """
+        loaded = self.states.load(self.state_path)
+        if not loaded:
+            return
+        items = self.states.items()
+        calls = [{'methodName': 'aria2.tellStatus', 'params': self.rpc_params(gid, ['status'])}
+                 for gid, _, _ in items]
+        try:
+            results = self.client.system.multicall(calls)
+        except Exception:
+            self.logger.exception(Exception)
+            return
+        lost = 0
+        for (gid, info_hash, _), r in zip(items, results):
+            if isinstance(r, list) and r:
+                method = RECONCILE_METHODS.get(r[0].get('status'))
+                if method:
+                    self.submit(gid, self.process_notification, method, gid, info_hash)
+            else:
+                lost += 1
+                self.states.update(gid, STATUS_ERROR)
+                self.save_magnet(info_hash, REDIS_PENDING_KEY)
+        self.logger.warning('reconciled {} downloads, {} lost'.format(len(items), lost))
+
+    def save_state_forever(self):
+        """定时清理过期的下载状态并保存快照"""
         while True:
-            for mgn in self.get_magnets(FETCH_MAGNET_COUNT):
-                gid = self.magnet_to_torrent(mgn, DIR_PATH)
-                self.logger.info('sending  <{}>  <gid, {}>'.format(mgn.decode(), gid))
-                self.save_magnet(mgn, REDIS_USED_KEY)
-                self.download_info.get('all').update({gid: mgn})
-                time.sleep(SINGLE_DOWNLOAD_WAIT_TIME)
-            time.sleep(WAITING_NEXT_TIME)
+            time.sleep(STATE_SAVE_INTERVAL)
+            self.states.expire()
+            self.save_state()
+            self.logger.info('downloads: {}'.format(self.states.stats()))
+
+    def save_state(self):
+        try:
+            self.states.save(self.state_path)
+        except OSError:
+            self.logger.exception(OSError)
 
     def get_magnets(self, count):
         return self.redis_client.get(count)
@@ -134,36 +280,100 @@ class Aria2MagnetConverter:
         # return an int
         while True:
             resp = socket_client.recv()
-            resp = json.loads(resp)
-            self.handle_aria2_notifications(resp)
+            try:
+                resp = json.loads(resp)
+                self.handle_aria2_notifications(resp)
+            except (ValueError, LookupError, AttributeError):
+                self.logger.warning('unknown notification {}'.format(resp))
 
     def handle_aria2_notifications(self, data):
+        """
+        接收通知的线程只做分发, 不等待也不调用 RPC, 处理放到线程池里
+
+        addUri 返回之前 aria2 就可能发来通知, 这时 gid 还没有和 info_hash 关联, 先放到 deferred 里,
+        由 link 关联时处理, 或者超时后由 resolve_deferred_forever 向 aria2 查询
+        """
         # {'jsonrpc': '2.0', 'method': 'aria2.onDownloadStart', 'params': [{'gid': '88d5dff6df0c610f'}]}
-        # print(data)
         method = data.get('method')
         gid = data.get('params')[0].get('gid')
-        # sleep 可以保证 magnet_to_torrent 把 <gid, magnet> 储存在 download_info 里
-        # 保证了下面可以正确取到 magnet
-        time.sleep(1)
-        magnet = self.download_info['all'].get(gid, b'')
-        # 如果是之前就有的下载任务, 直接去查找下载信息得到 magnet
-        if not magnet:
-            magnet = self.extract_magnet_from_status(gid)
+        if method in DOWNLOAD_FINISHED_METHODS:
+            # 空出了一个位置, 马上补充
+            self.slot_freed.set()
+        with self.lock:
+            info_hash = self.states.get(gid)
+            if not info_hash:
+                self.deferred.setdefault(gid, (time.time() + DEFER_TIME, [], 0))[1].append(method)
+                return
+            # 在锁里提交, 和 link 提交的之前放着的通知保持顺序
+            self.submit(gid, self.process_notification, method, gid, info_hash)
+
+    def submit(self, gid, fn, *args):
+        """按 gid 选择处理线程, 同一个 gid 的任务按提交的顺序处理"""
+        return self.executors[hash(gid) % len(self.executors)].submit(fn, *args)
+
+    def link(self, gid, info_hash, methods=()):
+        """关联 gid 和 info_hash, 按顺序处理 methods 和之前放着的这个 gid 的通知"""
+        with self.lock:
+            self.states.add(gid, info_hash)
+            methods = [*methods, *self.deferred.pop(gid, (None, (), 0))[1]]
+            for method in methods:
+                self.submit(gid, self.process_notification, method, gid, info_hash)
+
+    def resolve_deferred_forever(self):
+        """一直检查放着的通知, 超时还没有关联的 gid(比如重启前加入的下载)向 aria2 查询 info_hash"""
+        while True:
+            time.sleep(DEFER_CHECK_INTERVAL)
+            now = time.time()
+            with self.lock:
+                expired = [gid for gid, (deadline, _, _) in self.deferred.items() if deadline <= now]
+                expired = [(gid, *self.deferred.pop(gid)[1:]) for gid in expired]
+            for gid, methods, retries in expired:
+                self.submit(gid, self.resolve_gid, gid, methods, retries)
+
+    def resolve_gid(self, gid, methods, retries=0):
+        try:
+            info_hash = self.extract_magnet_from_status(gid)
+        except Exception:
+            self.logger.exception(Exception)
+            self.retry_gid(gid, methods, retries + 1)
+            return
+        if info_hash:
+            self.link(gid, info_hash, methods)
+
+    def retry_gid(self, gid, methods, retries):
+        """查询失败的 gid 放回 deferred, 等待的时间逐次加倍, 超过重试次数才放弃"""
+        if retries > RESOLVE_MAX_RETRIES:
+            self.logger.error('gave up resolving <gid, {}>, dropped {}'.format(gid, methods))
+            return
+        with self.lock:
+            # 等待期间又收到的通知也放在一起
+            newer = self.deferred.pop(gid, (None, [], 0))[1]
+            self.deferred[gid] = (time.time() + DEFER_TIME * 2 ** retries, methods + newer, retries)
+
+    def process_notification(self, method, gid, info_hash):
+        """在线程池里处理一个已经知道 info_hash 的通知"""
+        try:
+            self.handle_download_event(method, gid, info_hash)
+        except Exception:
+            self.logger.exception(Exception)
+
+    def handle_download_event(self, method, gid, info_hash):
+        magnet = info_hash_to_magnet(info_hash)
         if method == 'aria2.onDownloadStart':
-            self.logger.info('start  <{}>  <gid, {}>'.format(magnet.decode(), gid))
-            self.download_info.get('start').update({gid: magnet})
+            self.logger.info('start  <{}>  <gid, {}>'.format(magnet, gid))
+            self.states.update(gid, STATUS_START, info_hash)
             # 加入已使用 magnet
-            self.redis_client.add(magnet, REDIS_USED_KEY)
+            self.redis_client.add(info_hash, REDIS_USED_KEY)
         elif method == 'aria2.onDownloadComplete':
-            self.logger.info('complete  <{}>  <gid, {}>'.format(magnet.decode(), gid))
-            self.download_info.get('complete').update({gid: magnet})
+            self.logger.info('complete  <{}>  <gid, {}>'.format(magnet, gid))
+            self.states.update(gid, STATUS_COMPLETE, info_hash)
             # 加入可用 magnet
-            self.redis_client.add(magnet, REDIS_AVAIL_KEY)
+            self.redis_client.add(info_hash, REDIS_AVAIL_KEY)
             # 储存到数据库
-            self.save_to_sqlite(magnet.decode())
+            self.save_to_sqlite(info_hash)
         elif method in ['aria2.onDownloadError', 'aria2.onDownloadStop']:
-            self.logger.warning('error  <{}>  <gid, {}>'.format(magnet.decode(), gid))
-            self.download_info.get('error').update({gid: magnet})
+            self.logger.warning('error  <{}>  <gid, {}>'.format(magnet, gid))
+            self.states.update(gid, STATUS_ERROR, info_hash)
             # 因为 stop 的时候，aria2重启时还会开始这个任务，所以要主动删除信息
             self.remove_download_result(gid)
         else:
@@ -179,25 +389,30 @@ class Aria2MagnetConverter:
         if r != 'OK':
             self.logger.warning('没有成功清除所有下载信息！')
 
-    def save_to_sqlite(self, magnet):
-        if not magnet:
+    def save_to_sqlite(self, info_hash):
+        if not info_hash:
             return
-        torrent = os.path.join(DIR_PATH, magnet[-40:] + '.torrent')
+        # aria2 保存的种子文件名是小写 16 进制的 info_hash
+        torrent = os.path.join(DIR_PATH, info_hash.hex() + '.torrent')
         if os.path.exists(torrent):
-            self.logger.info('save {} to database'.format(magnet))
-            parser = TorrentParser(torrent)
+            self.logger.info('save {} to database'.format(info_hash_to_magnet(info_hash)))
+            with open(torrent, 'rb') as f:
+                content = f.read()
+            parser = TorrentParser(content)
             data = parser.get_torrent_info()
-            self.sqlite.insert(magnet, data)
+            self.sqlite.insert(info_hash, data)
+            self.store.put(info_hash, content)
+            os.remove(torrent)
         else:
             self.logger.error('不存在该文件 {}'.format(torrent))
 
     def extract_magnet_from_status(self, gid):
+        """从 aria2 的下载信息得到 20 字节的 info_hash"""
         r = self.client.aria2.tellStatus(RPC_SECRET, gid, ['infoHash'])
         info_hash = r.get('infoHash', None)
         magnet = None
         if info_hash:
-            magnet = 'magnet:?xt=urn:btih:' + info_hash.upper()
-            magnet = magnet.encode()
+            magnet = bytes.fromhex(info_hash)
         # 也可以这样
         # r = self.client.aria2.getFiles(RPC_SECRET, gid)[0]
         # path = r.get('path', None)
@@ -213,13 +428,20 @@ def start_magnet_converter():
     threads = [
         Thread(target=converter.magnet_to_torrent_forever),
         Thread(target=converter.receive_aria2_notifications),
+        Thread(target=converter.resolve_deferred_forever, daemon=True),
+        Thread(target=converter.save_state_forever, daemon=True),
     ]
 
-    for t in threads:
-        t.start()
+    try:
+        for t in threads:
+            t.start()
 
-    for t in threads:
-        t.join()
+        for t in threads:
+            t.join()
+    finally:
+        converter.save_state()
+        converter.sqlite.close()
+        converter.store.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,533 @@
+"""
+不依赖 aria2 的 magnet 转换: 用 asyncio 直接从 peer 下载种子的 metadata
+
+- PeerFinder: 在 DHT 里用 get_peers 查找拥有该 info_hash 的 peer, 从爬虫保存的路由表快照和回复过的节点开始查找
+- fetch_metadata: 和 peer 进行 BitTorrent 握手, 通过扩展协议(BEP 10)的 ut_metadata(BEP 9)下载 info 字典,
+  用 sha1 校验后返回
+- MetadataFetcher: 控制总的并发数, 每个 info_hash 同时尝试几个 peer, 先下载成功的为准
+- NativeMagnetConverter: 从 redis 取出 info_hash, 下载后保存为种子文件并写入数据库
+"""
+import asyncio
+import glob
+import hashlib
+import heapq
+import math
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bencoder import bdecode, bencode
+
+from magnet_crawler.crawler import BOOTSTRAP_NODES, TIMER_WAIT_TIME, BUCKET_SIZE, MAX_NODES_SIZE, SNAPSHOT_DIR
+from magnet_crawler.database import RedisClient, REDIS_USED_KEY, REDIS_AVAIL_KEY, REDIS_PENDING_KEY, SqliteWriter, \
+    SQLITE_DATABASE_NAME
+from magnet_crawler.krpc import encode_get_peers, random_bytes, random_id, random_tid, is_id
+from magnet_crawler.parse_torrent import TorrentParser
+from magnet_crawler.routing import RoutingTable
+from magnet_crawler.segments import SegmentStore
+from magnet_crawler.utils import parse_nodes, parse_peers, info_hash_to_magnet, get_logger
+
+# BitTorrent 握手: <19>BitTorrent protocol + 8 字节保留位 + info_hash + peer_id
+PROTOCOL_HEADER = b'\x13BitTorrent protocol'
+HANDSHAKE_LENGTH = 68
+# 保留位第 6 个字节的 0x10 表示支持扩展协议
+RESERVED = b'\x00\x00\x00\x00\x00\x10\x00\x00'
+EXTENSION_BIT_INDEX = 25
+EXTENSION_BIT = 0x10
+PEER_ID_PREFIX = b'-MC0001-'
+# 扩展协议的消息 id, 扩展握手的扩展 id 为 0
+EXTENDED_MESSAGE_ID = 20
+EXTENDED_HANDSHAKE_ID = 0
+# 我们给 ut_metadata 分配的扩展 id, 对方发来的 ut_metadata 消息使用这个 id
+UT_METADATA_ID = 1
+EXTENDED_HANDSHAKE = bencode({b'm': {b'ut_metadata': UT_METADATA_ID}})
+# ut_metadata 的消息类型
+METADATA_REQUEST = 0
+METADATA_DATA = 1
+METADATA_REJECT = 2
+METADATA_PIECE_SIZE = 16 * 1024
+# 超过这个大小的 metadata 不下载
+MAX_METADATA_SIZE = 10 * 1024 * 1024
+# 单个消息的长度上限, 超过的认为对方有问题. bitfield 之类的消息可能比 metadata 的分块大
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+# 连接 peer 的超时时间
+PEER_CONNECT_TIMEOUT = 3
+# 连接之后握手和下载 metadata 的超时时间
+PEER_TIMEOUT = 10
+# 每个 info_hash 同时尝试的 peer 数
+PEERS_PER_FETCH = 8
+# 每个 info_hash 最多尝试的 peer 数
+MAX_PEERS_PER_FETCH = 64
+# 每个 info_hash 的超时时间, 包括在 DHT 里查找 peer
+FETCH_TIMEOUT = 60
+# 先单独尝试已知的 peer(比如 announce_peer 的 peer)这么久, 都失败了才在 DHT 里查找
+KNOWN_PEERS_WAIT = 3
+# 同时下载的 info_hash 数
+MAX_CONCURRENT_FETCHES = 2000
+
+# get_peers 查找: 同时等待回复的请求数, 每次查找最多发送的请求数, 单个请求的超时时间
+LOOKUP_ALPHA = 8
+LOOKUP_MAX_QUERIES = 256
+LOOKUP_QUERY_TIMEOUT = 2
+# 每次查找从路由表里取离 info_hash 最近的这么多个节点开始
+LOOKUP_SEED_COUNT = 32
+# 爬虫保存的 IPv4 路由表快照, 启动时用来填充查找用的路由表
+LOOKUP_SNAPSHOT_PATTERN = 'nodes-*.dat'
+# 从 redis 每次取出的 info_hash 数量, 没有 info_hash 时的等待时间
+FETCH_MAGNET_COUNT = 256
+IDLE_TIME = 1
+
+
+class MetadataError(Exception):
+    """peer 不支持 ut_metadata, 拒绝了请求或者发来的数据不对"""
+
+
+def bencode_end(data, index=0):
+    """
+    从 index 开始的 bencode 值结束的位置
+
+    ut_metadata 的 data 消息是一个 bencode 字典后面直接跟着 metadata 的分块, 用它来分开两部分
+    """
+    c = data[index:index + 1]
+    if c == b'i':
+        return data.index(b'e', index) + 1
+    if c in (b'l', b'd'):
+        index += 1
+        while data[index:index + 1] != b'e':
+            if index >= len(data):
+                raise ValueError('unterminated bencode')
+            index = bencode_end(data, index)
+        return index + 1
+    if c.isdigit():
+        colon = data.index(b':', index)
+        end = colon + 1 + int(data[index:colon])
+        if end > len(data):
+            raise ValueError('bencode string out of range')
+        return end
+    raise ValueError('invalid bencode')
+
+
+def encode_extended(extended_id, payload):
+    """扩展协议消息: <长度><20><扩展 id><payload>"""
+    return (len(payload) + 2).to_bytes(4, 'big') + bytes((EXTENDED_MESSAGE_ID, extended_id)) + payload
+
+
+def encode_metadata_request(extended_id, piece):
+    return encode_extended(extended_id, b'd8:msg_typei%de5:piecei%dee' % (METADATA_REQUEST, piece))
+
+
+def random_peer_id():
+    return PEER_ID_PREFIX + random_bytes(20 - len(PEER_ID_PREFIX))
+
+
+async def read_message(reader):
+    """读取一个 peer wire 消息, keep-alive 返回 b''"""
+    length = int.from_bytes(await reader.readexactly(4), 'big')
+    if length > MAX_MESSAGE_SIZE:
+        raise MetadataError('message too large: {}'.format(length))
+    return await reader.readexactly(length) if length else b''
+
+
+async def download_metadata(reader, writer, info_hash, peer_id):
+    """在已经建立的连接上握手并下载 metadata"""
+    writer.write(PROTOCOL_HEADER + RESERVED + info_hash + peer_id)
+    writer.write(encode_extended(EXTENDED_HANDSHAKE_ID, EXTENDED_HANDSHAKE))
+    await writer.drain()
+    handshake = await reader.readexactly(HANDSHAKE_LENGTH)
+    if handshake[:20] != PROTOCOL_HEADER or handshake[28:48] != info_hash:
+        raise MetadataError('bad handshake')
+    if not handshake[EXTENSION_BIT_INDEX] & EXTENSION_BIT:
+        raise MetadataError('extension protocol not supported')
+
+    size = None
+    pieces = None
+    while True:
+        message = await read_message(reader)
+        if len(message) < 2 or message[0] != EXTENDED_MESSAGE_ID:
+            # keep-alive, bitfield, have 之类的消息
+            continue
+        extended_id, payload = message[1], message[2:]
+        if extended_id == EXTENDED_HANDSHAKE_ID and pieces is None:
+            data = bdecode(payload)
+            m = data.get(b'm')
+            peer_ut_metadata = m.get(b'ut_metadata') if isinstance(m, dict) else None
+            size = data.get(b'metadata_size')
+            if not isinstance(peer_ut_metadata, int) or not peer_ut_metadata:
+                raise MetadataError('ut_metadata not supported')
+            if not isinstance(size, int) or not 0 < size <= MAX_METADATA_SIZE:
+                raise MetadataError('bad metadata_size: {}'.format(size))
+            pieces = [None] * math.ceil(size / METADATA_PIECE_SIZE)
+            for i in range(len(pieces)):
+                writer.write(encode_metadata_request(peer_ut_metadata, i))
+            await writer.drain()
+        elif extended_id == UT_METADATA_ID and pieces is not None:
+            end = bencode_end(payload)
+            header = bdecode(payload[:end])
+            msg_type = header.get(b'msg_type')
+            piece = header.get(b'piece')
+            if msg_type == METADATA_REJECT:
+                raise MetadataError('request rejected')
+            if msg_type != METADATA_DATA or not isinstance(piece, int) or not 0 <= piece < len(pieces):
+                continue
+            pieces[piece] = payload[end:]
+            if all(p is not None for p in pieces):
+                metadata = b''.join(pieces)
+                if len(metadata) != size or hashlib.sha1(metadata).digest() != info_hash:
+                    raise MetadataError('metadata hash mismatch')
+                return metadata
+
+
+async def fetch_metadata(info_hash, address, peer_id=None, connect_timeout=PEER_CONNECT_TIMEOUT,
+                         timeout=PEER_TIMEOUT):
+    """
+    从一个 peer 下载 info_hash 的 metadata(种子的 info 字典), 失败时抛出异常
+
+    :param address: peer 的 (ip, port)
+    :return: 校验过的 metadata
+    """
+    peer_id = peer_id if peer_id else random_peer_id()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), connect_timeout)
+    try:
+        return await asyncio.wait_for(download_metadata(reader, writer, info_hash, peer_id), timeout)
+    finally:
+        writer.close()
+
+
+class PeerFinder(asyncio.DatagramProtocol):
+    """
+    在 DHT 里查找 peer, 所有查找共用一个 udp socket, 用 tid 区分回复属于哪个查找
+
+    回复过的节点保存在路由表里, 下一次查找从离 info_hash 最近的已知节点开始, 启动时用爬虫的路由表快照填充.
+    只有路由表里的节点太少时才向引导节点查询, 不会每个 magnet 都去请求公共的引导节点
+    """
+
+    def __init__(self, bootstrap_nodes=BOOTSTRAP_NODES, snapshot_dir=SNAPSHOT_DIR):
+        self.nid = random_id()
+        self.bootstrap_nodes = bootstrap_nodes
+        self.bootstrap_addresses = []
+        self.snapshot_dir = snapshot_dir
+        self.routing_table = RoutingTable(self.nid, BUCKET_SIZE, MAX_NODES_SIZE)
+        self.transport = None
+        # tid -> 等待回复的查找的队列
+        self.pending = dict()
+
+    async def start(self, bind_ip='0.0.0.0', bind_port=0):
+        """绑定 udp socket, 读取路由表快照, 解析引导节点的域名, 发送时就不会阻塞在 DNS 上"""
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(bind_ip, bind_port))
+        self.load_snapshots()
+        for host, port in self.bootstrap_nodes:
+            try:
+                infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            except OSError:
+                continue
+            self.bootstrap_addresses.extend(info[4][:2] for info in infos)
+
+    def load_snapshots(self):
+        """把爬虫保存的路由表快照里的节点加入路由表, 返回加入的节点数"""
+        count = 0
+        for path in glob.glob(os.path.join(self.snapshot_dir, LOOKUP_SNAPSHOT_PATTERN)):
+            for node in RoutingTable.read_snapshot(path):
+                if self.routing_table.restore(node):
+                    count += 1
+        return count
+
+    def seed_candidates(self, info_hash):
+        """查找开始时的 (距离, address): 路由表里离 info_hash 最近的节点, 节点太少时加上引导节点"""
+        target = int.from_bytes(info_hash, 'big')
+        nodes = self.routing_table.closest(info_hash, LOOKUP_SEED_COUNT)
+        candidates = [(int.from_bytes(node.nid, 'big') ^ target, node.address) for node in nodes]
+        if len(candidates) < LOOKUP_ALPHA:
+            # 引导节点的距离当作最远
+            candidates.extend((1 << 160, address) for address in self.bootstrap_addresses)
+        return candidates
+
+    def mark_responded(self, address, r):
+        """回复了的节点加入路由表"""
+        nid = r.get(b'id')
+        if is_id(nid):
+            self.routing_table.add(nid, *address)
+            self.routing_table.mark_seen(address)
+
+    def mark_timeout(self, address):
+        """没有回复的节点, 连续多次没有回复就从路由表里删除"""
+        node = self.routing_table.mark_failed(address)
+        if node and node.is_stale(time.time()):
+            self.routing_table.remove(address)
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            data = bdecode(data)
+            tid = data.get(b't')
+            r = data.get(b'r')
+        except Exception:
+            return
+        queue = self.pending.pop(tid, None)
+        if queue is not None and isinstance(r, dict):
+            queue.put_nowait((tid, r, addr[:2]))
+
+    def error_received(self, exc):
+        pass
+
+    async def find_peers(self, info_hash):
+        """
+        异步生成器, 从已知的节点开始向离 info_hash 越来越近的节点发送 get_peers, 一边查找一边返回找到的 peer
+
+        回复里的 values 是 peer, nodes 是离 info_hash 更近的节点, 每次只查询最近的还没查询过的节点
+        """
+        loop = asyncio.get_running_loop()
+        responses = asyncio.Queue()
+        target = int.from_bytes(info_hash, 'big')
+        # (和 info_hash 的距离, address)
+        candidates = self.seed_candidates(info_hash)
+        heapq.heapify(candidates)
+        queried = set()
+        found = set()
+        # tid -> (超时的时间, address)
+        in_flight = dict()
+        try:
+            while True:
+                while candidates and len(in_flight) < LOOKUP_ALPHA and len(queried) < LOOKUP_MAX_QUERIES:
+                    _, address = heapq.heappop(candidates)
+                    if address in queried:
+                        continue
+                    queried.add(address)
+                    tid = random_tid()
+                    self.pending[tid] = responses
+                    in_flight[tid] = (loop.time() + LOOKUP_QUERY_TIMEOUT, address)
+                    self.transport.sendto(encode_get_peers(tid, self.nid, info_hash), address)
+                if not in_flight:
+                    return
+                try:
+                    timeout = min(deadline for deadline, _ in in_flight.values()) - loop.time()
+                    tid, r, address = await asyncio.wait_for(responses.get(), max(0, timeout))
+                    in_flight.pop(tid, None)
+                    self.mark_responded(address, r)
+                    for peer in parse_peers(r.get(b'values')):
+                        if peer not in found:
+                            found.add(peer)
+                            yield peer
+                    for nid, ip, port in parse_nodes(r.get(b'nodes')):
+                        if (ip, port) not in queried:
+                            heapq.heappush(candidates, (int.from_bytes(nid, 'big') ^ target, (ip, port)))
+                except asyncio.TimeoutError:
+                    pass
+                now = loop.time()
+                for tid in [tid for tid, (deadline, _) in in_flight.items() if deadline <= now]:
+                    _, address = in_flight.pop(tid)
+                    self.pending.pop(tid, None)
+                    self.mark_timeout(address)
+        finally:
+            for tid in in_flight:
+                self.pending.pop(tid, None)
+
+
+class MetadataFetcher:
+    def __init__(self, finder=None, max_concurrent=MAX_CONCURRENT_FETCHES, peers_per_fetch=PEERS_PER_FETCH,
+                 max_peers=MAX_PEERS_PER_FETCH, timeout=FETCH_TIMEOUT):
+        """
+
+        :param finder: 用于查找 peer 的 PeerFinder, 为 None 时只尝试 fetch 时给出的 peer
+        :param max_concurrent: 同时下载的 info_hash 数
+        :param peers_per_fetch: 每个 info_hash 同时尝试的 peer 数
+        :param max_peers: 每个 info_hash 最多尝试的 peer 数
+        :param timeout: 每个 info_hash 的超时时间
+        """
+        self.finder = finder
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.peers_per_fetch = peers_per_fetch
+        self.max_peers = max_peers
+        self.timeout = timeout
+        self.peer_id = random_peer_id()
+        self.running = 0
+        self.fetched = 0
+        self.failed = 0
+        self.known_peer_fetched = 0
+        self.peer_errors = 0
+
+    async def fetch(self, info_hash, peers=()):
+        """
+        下载 info_hash 的 metadata, 先尝试给出的 peers, 再在 DHT 里查找
+
+        :return: 校验过的 metadata, 失败返回 None
+        """
+        async with self.semaphore:
+            self.running += 1
+            try:
+                metadata = await asyncio.wait_for(self.fetch_from_peers(info_hash, peers), self.timeout)
+            except asyncio.TimeoutError:
+                metadata = None
+            finally:
+                self.running -= 1
+        if metadata:
+            self.fetched += 1
+        else:
+            self.failed += 1
+        return metadata
+
+    async def iter_peers(self, info_hash):
+        if self.finder:
+            async for peer in self.finder.find_peers(info_hash):
+                yield peer
+
+    async def fetch_from_peers(self, info_hash, peers):
+        """
+        同时从多个 peer 下载, 第一个成功的为准, 其他的取消
+
+        已知的 peers 先单独尝试 KNOWN_PEERS_WAIT 秒, 大多数时候不需要再在 DHT 里查找
+        """
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        tried = set(peers)
+        sources = self.iter_peers(info_hash)
+        try:
+            for address in tried:
+                tasks.add(asyncio.ensure_future(self.fetch_from_peer(info_hash, address)))
+            deadline = loop.time() + KNOWN_PEERS_WAIT
+            while tasks and loop.time() < deadline:
+                metadata = await self.pop_result(tasks, timeout=deadline - loop.time())
+                if metadata:
+                    self.known_peer_fetched += 1
+                    return metadata
+            async for address in sources:
+                if address in tried:
+                    continue
+                tried.add(address)
+                tasks.add(asyncio.ensure_future(self.fetch_from_peer(info_hash, address)))
+                # 不等待的时候也看一下有没有已经完成的
+                metadata = await self.pop_result(tasks, wait=len(tasks) >= self.peers_per_fetch)
+                if metadata:
+                    return metadata
+                if len(tried) >= self.max_peers:
+                    break
+            while tasks:
+                metadata = await self.pop_result(tasks)
+                if metadata:
+                    return metadata
+            return None
+        finally:
+            await sources.aclose()
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    async def pop_result(tasks, wait=True, timeout=None):
+        """取出已经完成的下载, 有成功的返回 metadata. wait 为 True 时最多等 timeout 秒, 直到至少一个完成"""
+        if wait:
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            done = {task for task in tasks if task.done()}
+        tasks.difference_update(done)
+        for task in done:
+            if task.result():
+                return task.result()
+        return None
+
+    async def fetch_from_peer(self, info_hash, address):
+        try:
+            return await fetch_metadata(info_hash, address, self.peer_id)
+        except Exception:
+            # 任何一个 peer 出错(包括发来无法解码的 bencode)都只算这个 peer 失败, 不影响同时在下载的其他 peer.
+            # 取消不是 Exception, 会正常传出去
+            self.peer_errors += 1
+            return None
+
+
+class NativeMagnetConverter:
+    """代替 Aria2MagnetConverter, 在一个事件循环里同时下载成千上万个 metadata"""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_FETCHES, **kwargs):
+        self.max_concurrent = max_concurrent
+        self.redis_client = RedisClient()
+        self.sqlite = SqliteWriter(SQLITE_DATABASE_NAME).start()
+        self.store = SegmentStore()
+        self.logger = get_logger(kwargs.get('logger_name', 'METADATA'))
+        self.finder = PeerFinder()
+        self.fetcher = None
+        # 写文件和解析种子放到一个单独的线程里, 不阻塞事件循环
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.tasks = set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        await self.finder.start()
+        self.fetcher = MetadataFetcher(self.finder, self.max_concurrent)
+        self.logger.warning('start to fetch metadata, max concurrent fetches={}'.format(self.max_concurrent))
+        migrated = await loop.run_in_executor(self.executor, self.redis_client.migrate_pending)
+        if migrated:
+            self.logger.warning('migrated {} magnets to {}'.format(migrated, REDIS_PENDING_KEY))
+        last_report = time.time()
+        try:
+            while True:
+                count = min(self.max_concurrent - len(self.tasks), FETCH_MAGNET_COUNT)
+                info_hashes = []
+                if count > 0:
+                    # 先取最近 announce_peer 过的, 它们的 peer 很快就会过期, 不够再从 pending-magnet 里取
+                    info_hashes = await loop.run_in_executor(self.executor, self.redis_client.get_announced, count)
+                    if len(info_hashes) < count:
+                        info_hashes += await loop.run_in_executor(
+                            self.executor, self.redis_client.get, count - len(info_hashes))
+                # 爬虫保存的 announce_peer 的 peer, 先从它们下载
+                announced = await loop.run_in_executor(self.executor, self.redis_client.get_peers, info_hashes)
+                for info_hash, peers in zip(info_hashes, announced):
+                    task = asyncio.ensure_future(self.convert(info_hash, parse_peers(peers)))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                if time.time() - last_report > TIMER_WAIT_TIME:
+                    self.report()
+                    last_report = time.time()
+                # 取满了或者没有新的 info_hash 时等一会
+                await asyncio.sleep(IDLE_TIME if len(info_hashes) < FETCH_MAGNET_COUNT else 0)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.finder.close()
+            self.executor.shutdown()
+            self.sqlite.close()
+            self.store.close()
+
+    async def convert(self, info_hash, peers=()):
+        """下载一个 info_hash 的 metadata 并保存"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.redis_client.add, info_hash, REDIS_USED_KEY)
+        metadata = await self.fetcher.fetch(info_hash, peers)
+        magnet = info_hash_to_magnet(info_hash)
+        if not metadata:
+            self.logger.debug('failed  <{}>'.format(magnet))
+            return
+        self.logger.info('complete  <{}>'.format(magnet))
+        await loop.run_in_executor(self.executor, self.save_torrent, info_hash, metadata)
+
+    def save_torrent(self, info_hash, metadata):
+        """保存到段文件, 再写入数据库"""
+        content = b'd4:info' + metadata + b'e'
+        self.store.put(info_hash, content)
+        self.redis_client.add(info_hash, REDIS_AVAIL_KEY)
+        data = TorrentParser(content).get_torrent_info()
+        self.sqlite.insert(info_hash, data)
+
+    def report(self):
+        self.logger.info('正在下载{}个, 成功{}个(其中{}个来自已知的 peer), 失败{}个, peer 出错{}次'.format(
+            self.fetcher.running, self.fetcher.fetched, self.fetcher.known_peer_fetched, self.fetcher.failed,
+            self.fetcher.peer_errors))
+
+
+def start_native_converter():
+    converter = NativeMagnetConverter()
+    try:
+        asyncio.run(converter.run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    start_native_converter()
@@ -0,0 +1,196 @@
+"""
+迁移以前版本的数据
+
+- 以 magnet 字符串储存的数据迁移为 20 字节的 info_hash
+- 按 info_hash 分表的 magnet_X 表合并为 torrents 和 files 表, 并建立搜索索引
+- 为还没有短关键词索引(torrents_bigram)的种子补建索引
+
+迁移前需要先停止爬虫和转换, 迁移过程中新写入的数据可能会丢失
+"""
+import json
+import logging
+import sqlite3
+
+from magnet_crawler.database import RedisClient, REDIS_ALL_KEY, REDIS_USED_KEY, REDIS_AVAIL_KEY, \
+    REDIS_PENDING_KEY, CREATE_TABLE_SQL, SCHEMA_SQL, INSERT_BIGRAM_SQL, insert_torrents, to_bigrams
+from magnet_crawler.utils import magnet_to_info_hash
+
+REDIS_MIGRATE_KEYS = (REDIS_ALL_KEY, REDIS_USED_KEY, REDIS_AVAIL_KEY, REDIS_PENDING_KEY)
+# 每次从 redis 扫描和写入的数量
+MIGRATE_BATCH_SIZE = 10000
+
+
+def to_info_hash(magnet):
+    """magnet 链接转为 info_hash, 已经是 info_hash 的直接返回, 不能转换的返回 None"""
+    if magnet is None:
+        return None
+    if isinstance(magnet, bytes) and len(magnet) == 20:
+        return magnet
+    try:
+        return magnet_to_info_hash(magnet)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def migrate_redis(client=None, keys=REDIS_MIGRATE_KEYS):
+    """用 SSCAN 逐批转换每个集合, 写到临时 key, 全部完成后替换原来的 key"""
+    client = client if client else RedisClient().client
+    for key in keys:
+        if not client.exists(key):
+            continue
+        tmp_key = key + '-migrating'
+        client.delete(tmp_key)
+        count = 0
+        batch = []
+        for member in client.sscan_iter(key, count=MIGRATE_BATCH_SIZE):
+            info_hash = to_info_hash(member)
+            if info_hash:
+                batch.append(info_hash)
+            if len(batch) >= MIGRATE_BATCH_SIZE:
+                client.sadd(tmp_key, *batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            client.sadd(tmp_key, *batch)
+            count += len(batch)
+        if count:
+            client.rename(tmp_key, key)
+        else:
+            client.delete(key)
+        print('redis {} migrated, {} info_hash'.format(key, count))
+
+
+def get_sharded_tables(cursor):
+    return [row[0] for row in cursor.execute(
+        "select name from sqlite_master where type = 'table' and name like 'magnet\\_%' escape '\\'")]
+
+
+def migrate_sqlite(db):
+    """把 magnet_X 表里的 magnet 列转为 info_hash 列, 已经迁移过的表跳过"""
+    # 自己控制事务, 这样 alter table 和 create table 也在同一个事务里
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.create_function('to_info_hash', 1, to_info_hash)
+    cursor = conn.cursor()
+    try:
+        for name in get_sharded_tables(cursor):
+            columns = [row[1] for row in cursor.execute('pragma table_info({})'.format(name))]
+            if 'magnet' not in columns:
+                continue
+            old_name = name + '_old'
+            cursor.execute('begin')
+            cursor.execute('alter table {} rename to {}'.format(name, old_name))
+            cursor.execute(CREATE_TABLE_SQL.format(table_name=name))
+            # 同一个 info_hash 大小写不同的 magnet 只保留一个
+            cursor.execute('''
+            insert or ignore into {}(id, info_hash, torrent_name, content, create_date)
+            select id, to_info_hash(magnet), torrent_name, content, create_date
+            from {} where to_info_hash(magnet) is not null
+            '''.format(name, old_name))
+            cursor.execute('drop table {}'.format(old_name))
+            cursor.execute('commit')
+            print('table {} migrated'.format(name))
+    except sqlite3.Error as e:
+        logging.exception(e)
+        if conn.in_transaction:
+            cursor.execute('rollback')
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def load_content(content):
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def migrate_tables(db, batch_size=MIGRATE_BATCH_SIZE):
+    """
+    把 magnet_X 表里的数据合并到 torrents 和 files 表, 同时写入搜索索引
+
+    每个表在一个事务里迁移, 完成后删除这个表, 中断后再次运行会从还没有迁移的表继续
+    """
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.executescript(SCHEMA_SQL)
+    cursor = conn.cursor()
+    try:
+        for name in get_sharded_tables(cursor):
+            columns = [row[1] for row in cursor.execute('pragma table_info({})'.format(name))]
+            if 'info_hash' not in columns:
+                # 还是 magnet 字符串的表需要先用 migrate_sqlite 迁移
+                print('table {} skipped, run migrate_sqlite first'.format(name))
+                continue
+            cursor.execute('begin')
+            count = 0
+            rows = conn.execute('select info_hash, content, create_date from {}'.format(name))
+            while True:
+                batch = rows.fetchmany(batch_size)
+                if not batch:
+                    break
+                items = []
+                for info_hash, content, create_date in batch:
+                    data = load_content(content)
+                    if data is not None:
+                        items.append((info_hash, data, create_date))
+                count += insert_torrents(cursor, items)
+            rows.close()
+            cursor.execute('drop table {}'.format(name))
+            cursor.execute('commit')
+            print('table {} merged, {} torrents'.format(name, count))
+    except sqlite3.Error as e:
+        logging.exception(e)
+        if conn.in_transaction:
+            cursor.execute('rollback')
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def migrate_bigram(db, batch_size=MIGRATE_BATCH_SIZE):
+    """
+    torrents_bigram 是后来加的, 之前写入的种子按 id 分批补建索引, 已经有索引的跳过
+
+    每批在一个事务里写入, 中断后再次运行会继续
+    """
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.executescript(SCHEMA_SQL)
+    last_id = 0
+    count = 0
+    try:
+        while True:
+            torrents = conn.execute('select id, name from torrents where id > ? order by id limit ?',
+                                    (last_id, batch_size)).fetchall()
+            if not torrents:
+                break
+            first_id, last_id = torrents[0][0], torrents[-1][0]
+            # 不保存原文的 fts5 表也可以按 rowid 查询
+            indexed = {row[0] for row in conn.execute(
+                'select rowid from torrents_bigram where rowid between ? and ?', (first_id, last_id))}
+            paths = dict()
+            for torrent_id, path in conn.execute(
+                    'select torrent_id, path from files where torrent_id between ? and ? order by torrent_id, idx',
+                    (first_id, last_id)):
+                paths.setdefault(torrent_id, []).append(path or '')
+            rows = [(torrent_id, to_bigrams(name or ''), to_bigrams('\n'.join(paths.get(torrent_id, ()))))
+                    for torrent_id, name in torrents if torrent_id not in indexed]
+            if rows:
+                conn.execute('begin')
+                conn.executemany(INSERT_BIGRAM_SQL, rows)
+                conn.execute('commit')
+                count += len(rows)
+        print('torrents_bigram built, {} torrents'.format(count))
+    except sqlite3.Error as e:
+        logging.exception(e)
+        if conn.in_transaction:
+            conn.execute('rollback')
+    finally:
+        conn.close()
+
+
+def migrate_all(db):
+    migrate_redis()
+    migrate_sqlite(db)
+    migrate_tables(db)
+    migrate_bigram(db)
@@ -1,8 +1,9 @@
-import bencoder
+import hashlib
 import json
+import mmap
 from pprint import pprint
 
-from magnet_crawler.database import SqliteClient, SQLITE_DATABASE_NAME
+import bencoder
 
 
 def parse_torrent():
@@ -22,17 +23,161 @@ def parse_torrent():
     #     print(value)
 
 
+class BencodeReader:
+    """
+    按顺序读取 bencode 的游标
+
+    可以只解码需要的值, 其他的值只读出长度就跳过, 字符串不会被复制, 所以 pieces 这样的大字符串几乎没有开销.
+    data 可以是 bytes 或者 mmap
+    """
+
+    def __init__(self, data, index=0):
+        self.data = data
+        self.index = index
+
+    def peek(self):
+        return self.data[self.index:self.index + 1]
+
+    def find(self, sub):
+        end = self.data.find(sub, self.index)
+        if end < 0:
+            raise ValueError('unterminated bencode')
+        return end
+
+    def read_int(self):
+        end = self.find(b'e')
+        value = int(self.data[self.index + 1:end])
+        self.index = end + 1
+        return value
+
+    def skip_string(self):
+        """跳过一个字符串, 返回它的 (开始, 结束) 位置"""
+        colon = self.find(b':')
+        start = colon + 1
+        end = start + int(self.data[self.index:colon])
+        if end > len(self.data):
+            raise ValueError('bencode string out of range')
+        self.index = end
+        return start, end
+
+    def read_string(self):
+        start, end = self.skip_string()
+        return self.data[start:end]
+
+    def iter_list(self):
+        """
+        逐个读取列表, 每次 yield 时游标在下一个值的开头
+
+        调用者可以读取这个值, 没有读取的值会被跳过
+        """
+        self.index += 1
+        while self.peek() != b'e':
+            if not self.peek():
+                raise ValueError('unterminated bencode')
+            start = self.index
+            yield start
+            if self.index == start:
+                self.skip()
+        self.index += 1
+
+    def iter_dict(self):
+        """逐个读取字典, yield 出 key, 游标在对应的值的开头, 和 iter_list 一样没有读取的值会被跳过"""
+        self.index += 1
+        while self.peek() != b'e':
+            if not self.peek():
+                raise ValueError('unterminated bencode')
+            key = self.read_string()
+            start = self.index
+            yield key
+            if self.index == start:
+                self.skip()
+        self.index += 1
+
+    def skip(self):
+        c = self.peek()
+        if c == b'i':
+            self.index = self.find(b'e') + 1
+        elif c in (b'l', b'd'):
+            # 字典的 key 和值一样都是 bencode, 可以同样跳过
+            for _ in self.iter_list():
+                pass
+        elif c.isdigit():
+            self.skip_string()
+        else:
+            raise ValueError('invalid bencode')
+
+    def read(self):
+        """完整解码下一个值, 只用于比较小的值"""
+        c = self.peek()
+        if c == b'i':
+            return self.read_int()
+        if c == b'l':
+            return [self.read() for _ in self.iter_list()]
+        if c == b'd':
+            return {key: self.read() for key in self.iter_dict()}
+        if c.isdigit():
+            return self.read_string()
+        raise ValueError('invalid bencode')
+
+
 class TorrentParser:
+    # 需要解码的字段, 其他的字段(pieces 等)直接跳过
+    TORRENT_KEYS = (b'encoding', b'created by', b'creation date')
+    INFO_KEYS = (b'name', b'name.utf-8', b'length')
+    FILE_KEYS = (b'length', b'path', b'path.utf-8', b'attr')
+
     def __init__(self, torrent):
-        self.torrent = self.decode_torrent(torrent)  # all data is byte
+        """
+
+        :param torrent: 种子文件的路径, 或者种子文件的内容 bytes
+        """
         self.info = dict()
+        # info 字典的 sha1, 解析的同时计算
+        self.info_hash = None
+        self.torrent = self.decode_torrent(torrent)  # all data is byte
         self.encoding = self.torrent.get(b'encoding', b'utf-8').decode()
-        self.sqlite3 = SqliteClient(SQLITE_DATABASE_NAME)
 
     def decode_torrent(self, torrent):
+        if isinstance(torrent, (bytes, bytearray, memoryview)):
+            return self.read_torrent(bytes(torrent))
         with open(torrent, 'rb') as f:
-            content = bencoder.bdecode(f.read())
-        return content
+            # 用 mmap 读取, 跳过的部分不会被读进内存
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return self.read_torrent(data)
+
+    def read_torrent(self, data):
+        """只读出需要的字段, 同时计算 info_hash"""
+        reader = BencodeReader(data)
+        if reader.peek() != b'd':
+            raise ValueError('invalid torrent')
+        torrent = dict()
+        for key in reader.iter_dict():
+            if key in self.TORRENT_KEYS:
+                torrent[key] = reader.read()
+            elif key == b'info' and reader.peek() == b'd':
+                start = reader.index
+                torrent[key] = self.read_info(reader)
+                with memoryview(data) as view:
+                    self.info_hash = hashlib.sha1(view[start:reader.index]).digest()
+        return torrent
+
+    def read_info(self, reader):
+        info = dict()
+        for key in reader.iter_dict():
+            if key in self.INFO_KEYS:
+                info[key] = reader.read()
+            elif key == b'files' and reader.peek() == b'l':
+                info[key] = [self.read_file(reader) for _ in reader.iter_list()]
+        return info
+
+    def read_file(self, reader):
+        file = dict()
+        if reader.peek() != b'd':
+            return file
+        for key in reader.iter_dict():
+            if key in self.FILE_KEYS:
+                file[key] = reader.read()
+        return file
 
     def get_creation_info(self):
         created_by = self.torrent.get(b'created by', b'').decode()
@@ -42,58 +187,46 @@ class TorrentParser:
         return data
 
     def is_dir(self):
-        return b'files' in self.torrent.get(b'info').keys()
+        return b'files' in self.torrent.get(b'info', {})
+
+    def get_name(self, info):
+        if b'name.utf-8' in info:
+            return info[b'name.utf-8'].decode()
+        if b'name' in info:
+            return self.decode_all(info[b'name'], self.encoding)
+        return None
+
+    def get_path(self, file):
+        """文件在种子里的完整路径, 多层文件夹用 / 连接"""
+        if b'path.utf-8' in file:
+            return '/'.join(part.decode() for part in file[b'path.utf-8'])
+        if b'path' in file:
+            return '/'.join(self.decode_all(part, self.encoding) for part in file[b'path'])
+        return None
 
     def get_files_info(self):
         files = []
         # 如果没有 'files', 表示下载的是单文件, name 是文件名称
         # 如果有, 'name' 是文件夹名称, 文件全部在 'files' 里
-        tor_info = self.torrent[b'info']
+        tor_info = self.torrent.get(b'info', {})
         # 作为种子文件的名称
-        if b'name.utf-8' in tor_info.keys():
-            name = tor_info.get(b'name.utf-8').decode()
-        elif b'name' in tor_info.keys():
-            name = self.decode_all(tor_info.get(b'name'), self.encoding)
-        else:
-            name = None
-        # name = tor_info.get(b'name.utf-8', tor_info.get(b'name', b'').decode(self.encoding).encode()).decode()
-        # print(name)
+        name = self.get_name(tor_info)
         self.info.update(name=name)
 
         if self.is_dir():
-            for file in tor_info.get(b'files', []):
-                # TODO: 可能有多层文件夹
-                length = file.get(b'length', None)
-                if b'path.utf-8' in file.keys():
-                    name = file.get(b'path.utf-8')[0].decode()
-                elif b'path' in file.keys():
-                    # 处理多出的一层文件夹
-                    if len(file.get(b'path')) == 1:
-                        name = self.decode_all(file.get(b'path')[0], self.encoding)
-                    else:
-                        name = self.decode_all(file.get(b'path')[1], self.encoding)
-                else:
-                    name = None
-                new_file = {
-                    'length': length,
-                    'name': name,
-                }
-
-                # print(new_file)
-                files.append(new_file)
+            for file in tor_info[b'files']:
+                # BEP 47 的填充文件不是真正的文件
+                if b'p' in file.get(b'attr', b''):
+                    continue
+                files.append({
+                    'length': file.get(b'length', None),
+                    'name': self.get_path(file),
+                })
         else:
-            length = tor_info.get(b'length', None)
-            if b'name.utf-8' in tor_info.keys():
-                name = tor_info.get(b'name.utf-8').decode()
-            elif b'name' in tor_info.keys():
-                name = self.decode_all(tor_info.get(b'name'), self.encoding)
-            else:
-                name = None
-            file = {
-                'length': length,
+            files.append({
+                'length': tor_info.get(b'length', None),
                 'name': name,
-            }
-            files.append(file)
+            })
 
         return files
 
@@ -0,0 +1,327 @@
+"""
+Kademlia 路由表
+
+按照和自己 node id 的异或距离把节点放到 160 个 k-bucket 里, 每个 bucket 有容量上限,
+整张表也有容量上限, 所以内存是有界的. 节点按 (ip, port) 去重, 长时间没有回复的节点会被淘汰.
+
+爬虫要不断查询新节点, 表满了之后已经查询过的节点会让位给新发现的节点, 否则表里的节点都很活跃时
+就不会再加入新节点, 查询速度会被限制在 表容量 / REQUERY_INTERVAL.
+"""
+import heapq
+import os
+import struct
+import time
+from collections import OrderedDict, deque
+from socket import inet_ntop, inet_pton, AF_INET, AF_INET6
+from threading import RLock
+
+# node id 的位数
+ID_BITS = 160
+# 每个 k-bucket 的默认容量
+K = 8
+# 路由表默认最多保存的节点数
+MAX_TABLE_SIZE = 10000
+# 同一个节点两次查询的最小间隔
+REQUERY_INTERVAL = 60
+# 超过这个时间没有回复的节点视为过期
+NODE_STALE_TIME = 15 * 60
+# 连续这么多次查询都没有回复的节点视为过期
+MAX_NODE_FAILS = 3
+# RTT 指数加权平均的系数
+RTT_ALPHA = 0.125
+# 路由表快照文件: 文件头(标识, 版本, 节点数) + 每个节点一条定长记录
+SNAPSHOT_MAGIC = b'MCRT'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('!4sBI')
+# nid, ip, port, 最后回复时间, 查询次数, 回复次数, 平均 RTT
+SNAPSHOT_RECORD = struct.Struct('!20s4sHIHHf')
+# IPv6 路由表的快照, ip 为 16 字节
+SNAPSHOT_MAGIC6 = b'MCR6'
+SNAPSHOT_RECORD6 = struct.Struct('!20s16sHIHHf')
+SNAPSHOT_FORMATS = {
+    AF_INET: (SNAPSHOT_MAGIC, SNAPSHOT_RECORD),
+    AF_INET6: (SNAPSHOT_MAGIC6, SNAPSHOT_RECORD6),
+}
+
+
+class DHTNode:
+    __slots__ = ('nid', 'ip', 'port', 'last_seen', 'last_query', 'fails', 'queries', 'responses', 'rtt',
+                 'sample_after')
+
+    def __init__(self, nid, ip, port, last_seen=0):
+        self.nid = nid
+        self.ip = ip
+        self.port = port
+        # 最后一次收到该节点回复的时间
+        self.last_seen = last_seen
+        # 最后一次查询该节点的时间
+        self.last_query = 0
+        # 连续没有回复的查询次数
+        self.fails = 0
+        # 查询次数和收到回复的次数
+        self.queries = 0
+        self.responses = 0
+        # 平均 RTT, 没有测量过为 None
+        self.rtt = None
+        # 这个时间之后才能再发送 sample_infohashes
+        self.sample_after = 0
+
+    @property
+    def address(self):
+        return self.ip, self.port
+
+    @property
+    def success_rate(self):
+        return self.responses / self.queries if self.queries else 0
+
+    def is_stale(self, now):
+        return self.fails >= MAX_NODE_FAILS or (self.last_seen and now - self.last_seen > NODE_STALE_TIME)
+
+
+def distance(a, b):
+    """两个 id 的异或距离"""
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+class RoutingTable:
+    def __init__(self, nid, k=K, max_size=MAX_TABLE_SIZE, family=AF_INET):
+        """
+
+        :param nid: 自己的 node id
+        :param k: 每个 bucket 的容量
+        :param max_size: 整张表的容量
+        :param family: 节点的地址族, IPv4 和 IPv6 的节点分别放在两张表里
+        """
+        self.nid = nid
+        self.family = family
+        self.k = k
+        self.max_size = max_size
+        # buckets[i] 存放和自己的异或距离 bit_length 为 i 的节点, 按最后回复时间排序, 最久没回复的在前面
+        self.buckets = [OrderedDict() for _ in range(ID_BITS + 1)]
+        # (ip, port) -> node, 用于去重
+        self.addresses = dict()
+        # 还没有查询过的节点, 优先查询
+        self.fresh_queue = deque()
+        # 查询过的节点, 按最后查询时间排序, 轮流再次查询
+        self.query_queue = deque()
+        # thread 模式下收发线程会同时修改路由表
+        self.lock = RLock()
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __contains__(self, address):
+        return address in self.addresses
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.addresses.values()))
+
+    def bucket_index(self, nid):
+        return distance(self.nid, nid).bit_length()
+
+    def get(self, address):
+        return self.addresses.get(address)
+
+    def add(self, nid, ip, port):
+        """
+        加入一个新发现的节点
+
+        同一个 (ip, port) 只保存一次; bucket 或整张表满了会先用 make_room 腾出位置, 腾不出就丢弃新节点
+
+        :return: 加入的节点, 没有加入返回 None
+        """
+        with self.lock:
+            address = (ip, port)
+            if address in self.addresses or len(nid) != len(self.nid):
+                return None
+            bucket = self.buckets[self.bucket_index(nid)]
+            if len(bucket) >= self.k or len(self.addresses) >= self.max_size:
+                if not self.make_room(bucket):
+                    return None
+            node = DHTNode(nid, ip, port)
+            bucket[address] = node
+            self.addresses[address] = node
+            self.fresh_queue.append(node)
+            return node
+
+    def remove(self, address):
+        with self.lock:
+            node = self.addresses.pop(address, None)
+            if node:
+                self.buckets[self.bucket_index(node.nid)].pop(address, None)
+            return node
+
+    def make_room(self, bucket):
+        """
+        为新节点腾出一个位置
+
+        查询过的节点已经返回了它知道的节点, 可以让给新节点, 还没有查询过的节点不淘汰.
+        bucket 满了淘汰 bucket 里最久没有回复的节点, 只是整张表满了淘汰最早查询的节点
+        """
+        if len(bucket) >= self.k:
+            address, node = next(iter(bucket.items()))
+            if not node.queries and not node.is_stale(time.time()):
+                return False
+            self.remove(address)
+            return True
+        while self.query_queue:
+            node = self.query_queue.popleft()
+            if self.addresses.get(node.address) is node:
+                self.remove(node.address)
+                return True
+        return False
+
+    def mark_seen(self, address, rtt=None):
+        """收到了该节点的回复, rtt 为这次请求的往返时间"""
+        with self.lock:
+            node = self.addresses.get(address)
+            if node:
+                node.last_seen = time.time()
+                node.fails = 0
+                if rtt is not None:
+                    node.responses += 1
+                    node.rtt = rtt if node.rtt is None else node.rtt + RTT_ALPHA * (rtt - node.rtt)
+                self.buckets[self.bucket_index(node.nid)].move_to_end(address)
+            return node
+
+    def mark_failed(self, address):
+        """该节点的一次查询没有回复"""
+        with self.lock:
+            node = self.addresses.get(address)
+            if node:
+                node.fails += 1
+            return node
+
+    def next_node(self):
+        """
+        下一个要查询的节点
+
+        先查询新发现的节点, 然后所有查询过的节点按最后查询时间轮流查询, 同一个节点两次查询至少间隔
+        REQUERY_INTERVAL, 没有可以查询的节点返回 None.
+        请求超时由 mark_failed 记录, 多次查询都没有回复的节点在轮到它时被淘汰
+        """
+        with self.lock:
+            now = time.time()
+            while self.fresh_queue:
+                node = self.fresh_queue.popleft()
+                # 已经被删除的节点跳过
+                if self.addresses.get(node.address) is node:
+                    return self.start_query(node, now)
+            while self.query_queue:
+                node = self.query_queue[0]
+                if self.addresses.get(node.address) is not node:
+                    self.query_queue.popleft()
+                    continue
+                if node.is_stale(now):
+                    self.query_queue.popleft()
+                    self.remove(node.address)
+                    continue
+                # 队列按最后查询时间排序, 第一个还不能查询, 后面的也都不能
+                if now - node.last_query < REQUERY_INTERVAL:
+                    return None
+                self.query_queue.popleft()
+                return self.start_query(node, now)
+            return None
+
+    def start_query(self, node, now):
+        node.last_query = now
+        node.queries += 1
+        self.query_queue.append(node)
+        if len(self.query_queue) > 2 * len(self.addresses):
+            # 被淘汰的节点留在队列里, 太多时一次清理掉, 保持队列的长度有界
+            self.query_queue = deque(n for n in self.query_queue if self.addresses.get(n.address) is n)
+        return node
+
+    def closest(self, target, count=K):
+        """
+        离 target 最近的 count 个节点
+
+        按 closest_buckets 的顺序收集, 够 count 个就停止, 只在收集到的几个 bucket 里排序
+        """
+        with self.lock:
+            candidates = []
+            for index in self.closest_buckets(target):
+                candidates.extend(self.buckets[index].values())
+                if len(candidates) >= count:
+                    break
+            target = int.from_bytes(target, 'big')
+            return heapq.nsmallest(count, candidates, key=lambda n: int.from_bytes(n.nid, 'big') ^ target)
+
+    def closest_buckets(self, target):
+        """
+        按离 target 从近到远的顺序 yield bucket
+
+        target 所在的 bucket 最近. 更小的 bucket i 里的节点和 target 的距离在第 i - 1 位上和 d 相反
+        (d 是自己和 target 的距离), 所以 d 这一位为 1 的 bucket 比所有更小的 bucket 都近, 为 0 的比
+        所有更小的 bucket 都远. 更大的 bucket 按从小到大的顺序依次更远.
+        """
+        d = distance(self.nid, target)
+        index = d.bit_length()
+        yield index
+        lower = range(1, index)
+        yield from (i for i in reversed(lower) if d >> (i - 1) & 1)
+        if index:
+            yield 0
+        yield from (i for i in lower if not d >> (i - 1) & 1)
+        yield from range(index + 1, ID_BITS + 1)
+
+    def save(self, path):
+        """
+        把回复过的节点保存为快照, 用于重启后快速恢复
+
+        先写到临时文件再替换, 写到一半退出也不会损坏原来的快照
+        :return: 保存的节点数
+        """
+        now = time.time()
+        with self.lock:
+            nodes = [node for node in self.addresses.values() if node.last_seen and not node.is_stale(now)]
+        magic, record = SNAPSHOT_FORMATS[self.family]
+        records = [record.pack(node.nid, inet_pton(self.family, node.ip), node.port, int(node.last_seen),
+                               min(node.queries, 0xffff), min(node.responses, 0xffff), node.rtt or 0)
+                   for node in nodes]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(magic, SNAPSHOT_VERSION, len(records)))
+            f.write(b''.join(records))
+        os.replace(tmp_path, path)
+        return len(records)
+
+    @staticmethod
+    def read_snapshot(path, family=AF_INET):
+        """读取快照, 返回节点列表, 文件不存在或格式不对返回空列表"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return []
+        if len(data) < SNAPSHOT_HEADER.size:
+            return []
+        magic, version, count = SNAPSHOT_HEADER.unpack_from(data)
+        expected_magic, record = SNAPSHOT_FORMATS[family]
+        if magic != expected_magic or version != SNAPSHOT_VERSION:
+            return []
+        body = memoryview(data)[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + count * record.size]
+        # 文件被截断时丢掉最后不完整的记录
+        body = body[:len(body) - len(body) % record.size]
+        nodes = []
+        for nid, ip, port, last_seen, queries, responses, rtt in record.iter_unpack(body):
+            node = DHTNode(nid, inet_ntop(family, ip), port, last_seen)
+            node.queries = queries
+            node.responses = responses
+            node.rtt = rtt or None
+            nodes.append(node)
+        return nodes
+
+    def restore(self, node):
+        """加入从快照读出的节点, 保留它的统计信息"""
+        with self.lock:
+            added = self.add(node.nid, node.ip, node.port)
+            if added:
+                # 太久以前回复过的节点当作刚发现的节点, 不要在查询之前就被淘汰
+                if time.time() - node.last_seen <= NODE_STALE_TIME:
+                    added.last_seen = node.last_seen
+                added.queries = node.queries
+                added.responses = node.responses
+                added.rtt = node.rtt
+            return added
@@ -0,0 +1,345 @@
+"""
+种子文件的追加写入存储
+
+不再每个种子保存为一个 .torrent 文件, 而是把种子内容依次追加到很大的段文件(segment)里,
+内存里保存 info_hash -> (段, 偏移, 长度) 的索引, 读取时用 mmap 直接取出. 段文件只追加不修改,
+删除只是去掉索引并追加一条删除记录, 空间由 compact 重写段文件时回收.
+
+每条记录是 (info_hash, 长度) + 种子内容, 所以段文件本身就能重建索引; 索引定期保存为快照,
+启动时读取快照, 再扫描快照之后追加的部分.
+
+同一个目录只能被一个进程打开, 打开时对目录里的锁文件加排它锁, 已经被占用时抛出 SegmentLockedError.
+所以 pack/unpack/compact 需要先停止转换(magnet2torrent/metadata).
+"""
+import fcntl
+import mmap
+import os
+import re
+import struct
+from threading import RLock
+
+from magnet_crawler.database import SQLITE_BATCH_SIZE
+from magnet_crawler.importer import scan_torrents
+from magnet_crawler.parse_torrent import TorrentParser
+
+# 段文件和索引保存的目录
+SEGMENT_DIR = os.path.abspath('./segments')
+SEGMENT_NAME = 'segment-{:06d}.dat'
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{6})\.dat$')
+INDEX_NAME = 'index.dat'
+# 进程间互斥的锁文件
+LOCK_NAME = 'lock'
+# 段文件超过这个大小就写下一个段
+SEGMENT_MAX_SIZE = 256 * 1024 * 1024
+# 段文件里无效数据超过这个比例才重写
+COMPACT_GARBAGE_RATIO = 0.5
+# 记录头: info_hash, 内容长度, 长度为 DELETED 的是删除记录, 后面没有内容
+RECORD_HEADER = struct.Struct('!20sI')
+DELETED = 0xffffffff
+# 索引快照: 文件头(标识, 版本, 条目数, 当前段, 当前段保存时的大小) + 每个条目一条定长记录
+INDEX_MAGIC = b'MCSI'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('!4sBIIQ')
+# info_hash, 段, 内容的偏移, 内容的长度
+INDEX_RECORD = struct.Struct('!20sIII')
+
+
+class SegmentLockedError(Exception):
+    """段文件目录已经被其他进程打开"""
+
+
+class SegmentStore:
+    def __init__(self, path=SEGMENT_DIR, max_size=SEGMENT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        # info_hash -> (段, 偏移, 长度)
+        self.index = dict()
+        # 段 -> mmap, 只读
+        self.maps = dict()
+        self.active = None
+        self.active_file = None
+        self.active_size = 0
+        self.lock = RLock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.lock_file = self.acquire()
+        try:
+            self.open()
+        except BaseException:
+            self.lock_file.close()
+            raise
+
+    def acquire(self):
+        """对锁文件加排它锁, 进程退出时系统会自动释放"""
+        lock_file = open(os.path.join(self.path, LOCK_NAME), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise SegmentLockedError('{} 正在被其他进程使用, 请先停止转换'.format(self.path))
+        return lock_file
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, info_hash):
+        return info_hash in self.index
+
+    def keys(self):
+        with self.lock:
+            return list(self.index)
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, SEGMENT_NAME.format(segment))
+
+    def list_segments(self):
+        segments = []
+        for name in os.listdir(self.path):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def open(self):
+        """读取索引快照, 扫描快照之后追加的记录, 打开最后一个段继续追加"""
+        segments = self.list_segments()
+        active, active_size = self.load_index()
+        if active is None:
+            # 没有可用的快照, 扫描所有段重建索引
+            self.index.clear()
+            active, active_size = 0, 0
+        for segment in segments:
+            if segment < active:
+                continue
+            end = self.scan(segment, active_size if segment == active else 0)
+            if segment == segments[-1] and end < os.path.getsize(self.segment_path(segment)):
+                # 写到一半退出, 丢掉最后不完整的记录
+                with open(self.segment_path(segment), 'r+b') as f:
+                    f.truncate(end)
+        self.open_segment(segments[-1] if segments else 1)
+
+    def open_segment(self, segment):
+        if self.active_file:
+            self.active_file.close()
+        self.active = segment
+        self.active_file = open(self.segment_path(segment), 'ab')
+        self.active_size = self.active_file.tell()
+
+    def scan(self, segment, start=0):
+        """把段文件里 start 之后的记录加入索引, 返回最后一条完整记录结束的位置"""
+        path = self.segment_path(segment)
+        if os.path.getsize(path) <= start:
+            return start
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = start
+                while offset + RECORD_HEADER.size <= len(data):
+                    info_hash, length = RECORD_HEADER.unpack_from(data, offset)
+                    offset += RECORD_HEADER.size
+                    if length == DELETED:
+                        self.index.pop(info_hash, None)
+                        continue
+                    if offset + length > len(data):
+                        return offset - RECORD_HEADER.size
+                    self.index[info_hash] = (segment, offset, length)
+                    offset += length
+                return offset
+
+    def load_index(self):
+        """读取索引快照, 返回 (快照时的当前段, 当时的大小), 快照不可用返回 (None, 0)"""
+        try:
+            with open(os.path.join(self.path, INDEX_NAME), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None, 0
+        if len(data) < INDEX_HEADER.size:
+            return None, 0
+        magic, version, count, active, active_size = INDEX_HEADER.unpack_from(data)
+        body = memoryview(data)[INDEX_HEADER.size:]
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or len(body) != count * INDEX_RECORD.size:
+            return None, 0
+        for info_hash, segment, offset, length in INDEX_RECORD.iter_unpack(body):
+            self.index[info_hash] = (segment, offset, length)
+        return active, active_size
+
+    def save_index(self):
+        """
+        把追加的数据写入磁盘后保存索引快照, 先写到临时文件再替换
+
+        :return: 保存的条目数
+        """
+        with self.lock:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+            records = [INDEX_RECORD.pack(info_hash, *location) for info_hash, location in self.index.items()]
+            header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(records), self.active, self.active_size)
+            path = os.path.join(self.path, INDEX_NAME)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(header)
+                f.write(b''.join(records))
+            os.replace(tmp_path, path)
+            return len(records)
+
+    def append(self, info_hash, data, length):
+        """追加一条记录, 返回内容的 (段, 偏移)"""
+        if self.active_size >= self.max_size:
+            self.open_segment(self.active + 1)
+        self.active_file.write(RECORD_HEADER.pack(info_hash, length) + data)
+        # 写到操作系统, mmap 读取时才能看到
+        self.active_file.flush()
+        offset = self.active_size + RECORD_HEADER.size
+        self.active_size = offset + len(data)
+        return self.active, offset
+
+    def put(self, info_hash, data):
+        """保存一个种子的内容, 已经存在返回 False"""
+        with self.lock:
+            if info_hash in self.index:
+                return False
+            segment, offset = self.append(info_hash, data, len(data))
+            self.index[info_hash] = (segment, offset, len(data))
+            return True
+
+    def delete(self, info_hash):
+        with self.lock:
+            if self.index.pop(info_hash, None) is None:
+                return False
+            self.append(info_hash, b'', DELETED)
+            return True
+
+    def get_map(self, segment, size):
+        """段文件的 mmap, 当前段追加之后需要重新映射"""
+        data = self.maps.get(segment)
+        if data is None or len(data) < size:
+            if data is not None:
+                data.close()
+            with open(self.segment_path(segment), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = data
+        return data
+
+    def get(self, info_hash):
+        """种子的内容, 不存在返回 None"""
+        with self.lock:
+            location = self.index.get(info_hash)
+            if location is None:
+                return None
+            segment, offset, length = location
+            return self.get_map(segment, offset + length)[offset:offset + length]
+
+    def close_map(self, segment):
+        data = self.maps.pop(segment, None)
+        if data is not None:
+            data.close()
+
+    def compact(self, garbage_ratio=COMPACT_GARBAGE_RATIO):
+        """
+        重写无效数据太多的段: 把还有效的记录追加到当前段, 保存索引之后删除原来的段
+
+        开始时的当前段和之后的段不会被重写. 中途退出时原来的段还在, 重复的记录以后面的为准
+        :return: 回收的字节数
+        """
+        with self.lock:
+            active = self.active
+            live = dict()
+            for segment, offset, length in self.index.values():
+                live[segment] = live.get(segment, 0) + RECORD_HEADER.size + length
+            reclaimed = 0
+            for segment in self.list_segments():
+                if segment >= active:
+                    continue
+                size = os.path.getsize(self.segment_path(segment))
+                if size and live.get(segment, 0) / size > 1 - garbage_ratio:
+                    continue
+                if size:
+                    self.rewrite(segment)
+                # 先保存索引再删除段文件, 保证索引不会指向已经删除的段
+                self.save_index()
+                self.close_map(segment)
+                os.remove(self.segment_path(segment))
+                reclaimed += size - live.get(segment, 0)
+            return reclaimed
+
+    def rewrite(self, segment):
+        """把段里还有效的记录追加到当前段"""
+        data = self.get_map(segment, 0)
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            info_hash, length = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            if length == DELETED:
+                # 还没有被重新写入的才需要保留删除记录, 否则重建索引时更早的段里的记录会复活
+                if info_hash not in self.index:
+                    self.append(info_hash, b'', DELETED)
+                continue
+            if self.index.get(info_hash) == (segment, offset, length):
+                self.index[info_hash] = (*self.append(info_hash, data[offset:offset + length], length), length)
+            offset += length
+
+    def close(self):
+        with self.lock:
+            self.save_index()
+            self.active_file.close()
+            for segment in list(self.maps):
+                self.close_map(segment)
+            # 关闭文件即释放锁
+            self.lock_file.close()
+
+
+def pack_directory(store, directory, sqlite, remove=True):
+    """
+    把目录里的 .torrent 文件导入段文件, 同时写入数据库(已经写入的跳过)
+
+    删除的文件必须已经在数据库里, 否则先 pack 再 import 时这些种子就不会再被写入数据库.
+    解析失败的文件不导入也不删除
+
+    :param sqlite: SqliteClient
+    :param remove: 导入并保存索引之后删除原来的文件
+    :return: 导入的文件数
+    """
+    imported = []
+    batch = []
+    for info_hash, path in scan_torrents(directory):
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            parser = TorrentParser(data)
+            if parser.info_hash is None:
+                continue
+            info = parser.get_torrent_info()
+        except ValueError:
+            continue
+        store.put(parser.info_hash, data)
+        batch.append((parser.info_hash, info))
+        imported.append(path)
+        if len(batch) >= SQLITE_BATCH_SIZE:
+            sqlite.insert_many(batch)
+            batch = []
+    if batch:
+        sqlite.insert_many(batch)
+    store.save_index()
+    if remove:
+        for path in imported:
+            os.remove(path)
+    return len(imported)
+
+
+def unpack_directory(store, directory, info_hashes=None):
+    """
+    把段文件里的种子导出为 <info_hash>.torrent 文件
+
+    :param info_hashes: 要导出的 info_hash, 默认全部导出
+    :return: 导出的文件数
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    count = 0
+    for info_hash in info_hashes if info_hashes is not None else store.keys():
+        data = store.get(info_hash)
+        if data is None:
+            continue
+        with open(os.path.join(directory, info_hash.hex() + '.torrent'), 'wb') as f:
+            f.write(data)
+        count += 1
+    return count
@@ -0,0 +1,152 @@
+"""
+magnet 转换的下载状态
+
+只保存还在下载的 gid -> info_hash, 下载结束(完成或出错)后只留下计数. 条目数有上限(LRU),
+太久没有结束的条目按 TTL 过期, 所以长时间运行内存也不会增长. 状态可以保存为快照, 重启后恢复,
+用于和 aria2 里还在的下载任务核对.
+"""
+import os
+import struct
+import time
+from collections import OrderedDict
+from threading import RLock
+
+# 最多保存的下载中的条目数
+MAX_STATES = 10000
+# 超过这个时间还没有结束的条目直接丢弃
+STATE_TTL = 60 * 60
+# 下载状态
+STATUS_SENT = 0
+STATUS_START = 1
+STATUS_COMPLETE = 2
+STATUS_ERROR = 3
+STATUS_NAMES = ('sent', 'start', 'complete', 'error')
+FINISHED_STATUSES = (STATUS_COMPLETE, STATUS_ERROR)
+# 快照: 文件头(标识, 版本, 条目数, 各状态的计数, 过期的计数) + 每个条目一条定长记录
+STATE_MAGIC = b'MCDS'
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct('!4sBI' + 'Q' * (len(STATUS_NAMES) + 1))
+# gid(aria2 的 gid 是 16 位 16 进制), info_hash, 状态, 更新时间
+STATE_RECORD = struct.Struct('!8s20sBI')
+
+
+class DownloadState:
+    __slots__ = ('info_hash', 'status', 'updated_at')
+
+    def __init__(self, info_hash, status=STATUS_SENT, updated_at=None):
+        self.info_hash = info_hash
+        self.status = status
+        self.updated_at = updated_at if updated_at else time.time()
+
+
+class DownloadStateStore:
+    def __init__(self, max_size=MAX_STATES, ttl=STATE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # gid -> DownloadState, 最近更新的在后面
+        self.states = OrderedDict()
+        # 每个状态累计的数量
+        self.counters = [0] * len(STATUS_NAMES)
+        self.expired = 0
+        self.lock = RLock()
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, gid):
+        return gid in self.states
+
+    def items(self):
+        with self.lock:
+            return [(gid, state.info_hash, state.status) for gid, state in self.states.items()]
+
+    def get(self, gid):
+        """gid 对应的 info_hash, 不在下载中返回 None"""
+        state = self.states.get(gid)
+        return state.info_hash if state else None
+
+    def add(self, gid, info_hash):
+        """加入一个刚发给 aria2 的下载, 满了丢弃最久没有更新的"""
+        with self.lock:
+            self.states[gid] = DownloadState(info_hash)
+            self.states.move_to_end(gid)
+            self.counters[STATUS_SENT] += 1
+            while len(self.states) > self.max_size:
+                self.states.popitem(last=False)
+                self.expired += 1
+
+    def update(self, gid, status, info_hash=None):
+        """
+        更新下载状态, 结束的下载只计数不再保存
+
+        :return: gid 对应的 info_hash, 不知道的返回传入的 info_hash
+        """
+        with self.lock:
+            self.counters[status] += 1
+            state = self.states.get(gid)
+            if state is None:
+                if status not in FINISHED_STATUSES and info_hash:
+                    self.states[gid] = DownloadState(info_hash, status)
+                return info_hash
+            if status in FINISHED_STATUSES:
+                del self.states[gid]
+            else:
+                state.status = status
+                state.updated_at = time.time()
+                self.states.move_to_end(gid)
+            return state.info_hash
+
+    def expire(self):
+        """丢弃超过 TTL 的条目, 返回丢弃的 [(gid, info_hash), ...]"""
+        deadline = time.time() - self.ttl
+        expired = []
+        with self.lock:
+            while self.states:
+                gid, state = next(iter(self.states.items()))
+                if state.updated_at > deadline:
+                    break
+                self.states.popitem(last=False)
+                expired.append((gid, state.info_hash))
+            self.expired += len(expired)
+        return expired
+
+    def stats(self):
+        counters = dict(zip(STATUS_NAMES, self.counters))
+        counters.update(running=len(self.states), expired=self.expired)
+        return counters
+
+    def save(self, path):
+        """先写到临时文件再替换, 返回保存的条目数"""
+        with self.lock:
+            records = [STATE_RECORD.pack(bytes.fromhex(gid), state.info_hash, state.status, int(state.updated_at))
+                       for gid, state in self.states.items()]
+            header = STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, len(records), *self.counters, self.expired)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(b''.join(records))
+        os.replace(tmp_path, path)
+        return len(records)
+
+    def load(self, path):
+        """从快照恢复, 文件不存在或格式不对时什么也不做, 返回恢复的条目数"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return 0
+        if len(data) < STATE_HEADER.size:
+            return 0
+        magic, version, count, *counters = STATE_HEADER.unpack_from(data)
+        if magic != STATE_MAGIC or version != STATE_VERSION:
+            return 0
+        body = memoryview(data)[STATE_HEADER.size:STATE_HEADER.size + count * STATE_RECORD.size]
+        body = body[:len(body) - len(body) % STATE_RECORD.size]
+        with self.lock:
+            self.counters = counters[:len(STATUS_NAMES)]
+            self.expired = counters[-1]
+            for gid, info_hash, status, updated_at in STATE_RECORD.iter_unpack(body):
+                self.states[gid.hex()] = DownloadState(info_hash, status, updated_at)
+            while len(self.states) > self.max_size:
+                self.states.popitem(last=False)
+        return len(self.states)
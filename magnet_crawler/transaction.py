@@ -0,0 +1,177 @@
+"""
+KRPC 请求的 transaction 跟踪和发送速率控制
+
+每个发出的请求都记录在 TransactionTable 里, 收到回复时用 tid 找到对应的请求, 得到 RTT;
+超时没有回复的请求被清理掉并记为失败. RateController 根据回复率和 RTT 用 AIMD 调整发送速率.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from magnet_crawler.krpc import random_tid
+
+# 请求超时时间
+TRANSACTION_TIMEOUT = 10
+# 最多同时等待回复的请求数, 超过时最早的请求直接记为超时
+MAX_TRANSACTIONS = 65536
+
+# 初始发送速率, 包/秒
+INITIAL_RATE = 500
+MIN_RATE = 50
+MAX_RATE = 20000
+# 每个窗口没有拥塞时增加的速率
+RATE_INCREASE = 50
+# 拥塞时速率乘以这个系数
+RATE_DECREASE = 0.7
+# 调整速率的窗口时间
+RATE_WINDOW = 5
+# 窗口内超时比例超过这个值视为拥塞. DHT 里很多节点本来就不会回复, 所以这个值不能太小
+LOSS_THRESHOLD = 0.6
+# 窗口内平均 RTT 超过基准 RTT 的这么多倍视为拥塞.
+# 不同节点的 RTT 差别很大(几十到几百毫秒), 所以基准是以前窗口的平均 RTT, 而不是单个节点的最小 RTT
+RTT_THRESHOLD = 2
+# 基准 RTT 指数加权平均的系数, RTT 长期变化后基准会慢慢跟上
+RTT_BASELINE_ALPHA = 0.1
+# 令牌桶容量, 允许的突发包数
+RATE_BURST = 64
+
+
+class Transaction:
+    __slots__ = ('tid', 'address', 'query', 'sent_at')
+
+    def __init__(self, tid, address, query, sent_at):
+        self.tid = tid
+        self.address = address
+        self.query = query
+        self.sent_at = sent_at
+
+
+class TransactionTable:
+    def __init__(self, timeout=TRANSACTION_TIMEOUT, max_size=MAX_TRANSACTIONS):
+        self.timeout = timeout
+        self.max_size = max_size
+        # tid -> Transaction, 按发送时间排序
+        self.pending = OrderedDict()
+        self.lock = Lock()
+        self.sent = 0
+        self.answered = 0
+        self.timeouts = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, address, query):
+        """记录一个请求, 返回它的 tid"""
+        with self.lock:
+            tid = random_tid()
+            while tid in self.pending:
+                tid = random_tid()
+            self.pending[tid] = Transaction(tid, address, query, time.time())
+            self.sent += 1
+            return tid
+
+    def pop(self, tid):
+        """收到回复, 返回对应的请求, 没有找到(已超时或不是我们发的)返回 None"""
+        with self.lock:
+            transaction = self.pending.pop(tid, None)
+            if transaction:
+                self.answered += 1
+            return transaction
+
+    def expire(self):
+        """清理超时的请求并返回"""
+        deadline = time.time() - self.timeout
+        expired = []
+        with self.lock:
+            while self.pending:
+                transaction = next(iter(self.pending.values()))
+                if transaction.sent_at > deadline and len(self.pending) <= self.max_size:
+                    break
+                self.pending.popitem(last=False)
+                expired.append(transaction)
+            self.timeouts += len(expired)
+        return expired
+
+    @property
+    def answer_rate(self):
+        finished = self.answered + self.timeouts
+        return self.answered / finished if finished else 0
+
+
+class RateController:
+    """
+    AIMD 发送速率控制
+
+    每个窗口统计回复和超时数量, 超时比例或平均 RTT 比以前的窗口高很多时速率乘以 decrease, 否则加上 increase.
+    发送时用令牌桶按当前速率放行
+    """
+
+    def __init__(self, rate=INITIAL_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE, increase=RATE_INCREASE,
+                 decrease=RATE_DECREASE, window=RATE_WINDOW, burst=RATE_BURST):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.burst = burst
+        self.tokens = burst
+        self.refilled_at = time.time()
+        self.window_start = self.refilled_at
+        self.responses = 0
+        self.timeouts = 0
+        self.rtt_sum = 0
+        # 以前窗口的平均 RTT
+        self.base_rtt = None
+
+    def on_response(self, rtt):
+        self.responses += 1
+        self.rtt_sum += rtt
+        self.update()
+
+    def on_timeout(self, count=1):
+        self.timeouts += count
+        self.update()
+
+    def is_congested(self):
+        finished = self.responses + self.timeouts
+        if finished and self.timeouts / finished > LOSS_THRESHOLD:
+            return True
+        if self.responses and self.base_rtt and self.rtt_sum / self.responses > self.base_rtt * RTT_THRESHOLD:
+            return True
+        return False
+
+    def update(self):
+        """每个窗口调整一次速率"""
+        now = time.time()
+        if now - self.window_start < self.window:
+            return
+        if self.responses + self.timeouts:
+            if self.is_congested():
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+        if self.responses:
+            rtt = self.rtt_sum / self.responses
+            self.base_rtt = rtt if self.base_rtt is None else self.base_rtt + RTT_BASELINE_ALPHA * (rtt - self.base_rtt)
+        self.window_start = now
+        self.responses = self.timeouts = 0
+        self.rtt_sum = 0
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def take(self):
+        """可以发送一个包时返回 True"""
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        """距离可以发送下一个包还要等待的时间"""
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
@@ -1,34 +1,100 @@
 import logging
-import random
-import string
-from _socket import inet_ntoa
+from _socket import inet_aton, inet_ntoa, inet_ntop, inet_pton, AF_INET6
 
-from struct import unpack
+from struct import Struct
 
 # 每个node节点信息的长度
 COMPACT_NODE_INFO_LENGTH = 26
 # 每个node节点长度
 COMPACT_NODE_LENGTH = 20
+MAGNET_TEMPLATE = "magnet:?xt=urn:btih:{}"
+# 每个node信息，20：nid 4：ip 2：port
+COMPACT_NODE_STRUCT = Struct('!20s4sH')
+# BEP 32 IPv6 节点信息, 20：nid 16：ip 2：port
+COMPACT_NODE6_INFO_LENGTH = 38
+COMPACT_NODE6_STRUCT = Struct('!20s16sH')
+# get_peers 回复的 values 里每个 peer 的信息, 4：ip 2：port
+COMPACT_PEER_STRUCT = Struct('!4sH')
+# IPv6 的 peer, 16：ip 2：port
+COMPACT_PEER6_STRUCT = Struct('!16sH')
 
 
-def get_random_id(length):
-    str_list = [random.choice(string.digits + string.ascii_letters) for i in range(length)]
-    random_str = ''.join(str_list)
-    return random_str
+def _invalid_ip_prefixes():
+    """不能作为 DHT 节点的 ip 的前两个字节: 本地, 私有, 组播和保留地址"""
+    prefixes = set()
+    for first in (0, 10, 127, *range(224, 256)):
+        prefixes.update(bytes((first, second)) for second in range(256))
+    prefixes.update(bytes((172, second)) for second in range(16, 32))
+    prefixes.update(bytes((100, second)) for second in range(64, 128))
+    prefixes.update((bytes((192, 168)), bytes((169, 254))))
+    return frozenset(prefixes)
+
+
+INVALID_IP_PREFIXES = _invalid_ip_prefixes()
 
 
 def parse_nodes(data):
-    nodes = []
-    if data:
-        length = len(data)
-        # 每个node信息，20：nid 4：ip 2：port
-        for i in range(0, length, COMPACT_NODE_INFO_LENGTH):
-            nid = data[i:i + 20]
-            ip = inet_ntoa(data[i + 20:i + 24])
-            port = unpack("!H", data[i + 24:i + 26])[0]
-            nodes.append((nid, ip, port))
+    """
+    解析 compact node info, 返回 [(nid, ip, port), ...]
+
+    在 memoryview 上用 struct.iter_unpack 一次解析整个 nodes, 不再逐个切片,
+    端口为 0 和私有、保留地址的节点在转换 ip 之前就被过滤掉
+    """
+    if not data:
+        return []
+    # 丢掉末尾不完整的部分, iter_unpack 要求长度是整数倍
+    view = memoryview(data)[:len(data) - len(data) % COMPACT_NODE_INFO_LENGTH]
+    return [(nid, inet_ntoa(ip), port) for nid, ip, port in COMPACT_NODE_STRUCT.iter_unpack(view)
+            if port and ip[:2] not in INVALID_IP_PREFIXES]
+
+
+def pack_nodes(nodes):
+    """把 DHTNode 编码为 compact node info, 和 parse_nodes 相反"""
+    return b''.join(COMPACT_NODE_STRUCT.pack(node.nid, inet_aton(node.ip), node.port) for node in nodes)
+
+
+def parse_nodes6(data):
+    """
+    解析 nodes6 里的 IPv6 compact node info, 返回 [(nid, ip, port), ...]
+
+    只保留全球单播地址(2000::/3), 本地, 链路本地, 组播和 IPv4 映射地址都被过滤掉
+    """
+    if not data:
+        return []
+    view = memoryview(data)[:len(data) - len(data) % COMPACT_NODE6_INFO_LENGTH]
+    return [(nid, inet_ntop(AF_INET6, ip), port) for nid, ip, port in COMPACT_NODE6_STRUCT.iter_unpack(view)
+            if port and ip[0] & 0xe0 == 0x20]
+
 
-    return nodes
+def pack_nodes6(nodes):
+    """把 IPv6 的 DHTNode 编码为 nodes6"""
+    return b''.join(COMPACT_NODE6_STRUCT.pack(node.nid, inet_pton(AF_INET6, node.ip), node.port) for node in nodes)
+
+
+def parse_peers(values):
+    """解析 get_peers 回复里的 values 或者保存的 compact peer 列表, 返回 [(ip, port), ...]"""
+    if not isinstance(values, (list, set)):
+        return []
+    peers = []
+    for value in values:
+        if not isinstance(value, bytes):
+            continue
+        if len(value) == COMPACT_PEER_STRUCT.size:
+            ip, port = COMPACT_PEER_STRUCT.unpack(value)
+            if port and ip[:2] not in INVALID_IP_PREFIXES:
+                peers.append((inet_ntoa(ip), port))
+        elif len(value) == COMPACT_PEER6_STRUCT.size:
+            ip, port = COMPACT_PEER6_STRUCT.unpack(value)
+            if port and ip[0] & 0xe0 == 0x20:
+                peers.append((inet_ntop(AF_INET6, ip), port))
+    return peers
+
+
+def pack_peer(ip, port):
+    """把 peer 编码为 compact peer info, IPv4 为 6 字节, IPv6 为 18 字节"""
+    if ':' in ip:
+        return COMPACT_PEER6_STRUCT.pack(inet_pton(AF_INET6, ip), port)
+    return COMPACT_PEER_STRUCT.pack(inet_aton(ip), port)
 
 
 def parse_info_hash(data):
@@ -38,6 +104,18 @@ def parse_info_hash(data):
     return magnet
 
 
+def info_hash_to_magnet(info_hash):
+    """20 字节的 info_hash 转为 magnet 链接, 只在需要给外部(aria2, 日志)使用时转换"""
+    return MAGNET_TEMPLATE.format(parse_info_hash(info_hash))
+
+
+def magnet_to_info_hash(magnet):
+    """magnet 链接(str 或 bytes)或 40 位 16 进制字符串转为 20 字节的 info_hash"""
+    if isinstance(magnet, bytes):
+        magnet = magnet.decode()
+    return bytes.fromhex(magnet[-40:])
+
+
 def get_logger(name, level=logging.INFO):
     logger = logging.getLogger(name)
     logger.setLevel(level)
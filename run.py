@@ -1,15 +1,26 @@
 import argparse
 from multiprocessing import Process
 
-from magnet_crawler.crawler import start_multi_server, DEFAULT_SERVER_COUNT, DEFAULT_SERVER_PORT
-from magnet_crawler.database import create_tables
-from magnet_crawler.magnet2torrent import start_magnet_converter
+from magnet_crawler.crawler import start_multi_server, DEFAULT_SERVER_COUNT, DEFAULT_SERVER_PORT, DEFAULT_SERVER_MODE, \
+    DEFAULT_SOCKETS_PER_PROCESS, SERVER_MODES
+from magnet_crawler.database import create_tables, SqliteClient
+from magnet_crawler.importer import import_torrents
+from magnet_crawler.magnet2torrent import start_magnet_converter, DIR_PATH
+from magnet_crawler.metadata import start_native_converter
+from magnet_crawler.migrate import migrate_all
+from magnet_crawler.segments import SegmentStore, pack_directory, unpack_directory
 
+# magnet 转换方式: aria2 通过 RPC 交给 aria2 下载, native 用内置的 ut_metadata 下载
+CONVERTERS = {
+    'aria2': start_magnet_converter,
+    'native': start_native_converter,
+}
 
-def start_all(crawler_args, converter_args):
+
+def start_all(crawler_args, converter_args, converter=start_magnet_converter):
     processes = [
         Process(target=start_multi_server, args=crawler_args),
-        Process(target=start_magnet_converter, args=converter_args),
+        Process(target=converter, args=converter_args),
     ]
 
     for p in processes:
@@ -24,24 +35,62 @@ if __name__ == '__main__':
 
     parser.add_argument("runserver", nargs='?', help='启动')
     parser.add_argument("createdatabase", nargs='?', help='创建数据库', default='magnet.db')
-    parser.add_argument("-c", "--count", help="指定爬虫进程数", default=DEFAULT_SERVER_COUNT)
+    parser.add_argument("-c", "--count", type=int, help="指定爬虫进程数", default=DEFAULT_SERVER_COUNT)
     parser.add_argument("-p", "--port", type=int, help="指定爬虫绑定端口起始位置", default=DEFAULT_SERVER_PORT)
+    parser.add_argument("-m", "--mode", choices=SERVER_MODES, help="爬虫运行模式", default=DEFAULT_SERVER_MODE)
+    parser.add_argument("-s", "--sockets", type=int, help="async 模式下每个进程绑定的 socket 数量",
+                        default=DEFAULT_SOCKETS_PER_PROCESS)
+    parser.add_argument("--sample", help="使用 sample_infohashes (BEP 51) 主动采集", action="store_true")
+    parser.add_argument("--ipv6", help="同时爬取 IPv6 的 DHT 网络 (BEP 32)", action="store_true")
+    parser.add_argument("--converter", choices=CONVERTERS.keys(), help="magnet 转换方式", default='aria2')
     parser.add_argument("--only-crawler", help="只运行爬虫", action="store_true", dest='crawler')
     parser.add_argument("--only-convert", help="只运行 magnet 转换", action="store_true", dest='convert')
+    parser.add_argument("-k", "--keyword", help="search 时按种子名称和文件名搜索的关键词")
+    parser.add_argument("-d", "--directory", help="import/pack 时导入的种子文件目录, unpack 时导出的目录",
+                        default=DIR_PATH)
+    parser.add_argument("-w", "--workers", type=int, help="import 时解析种子的进程数, 默认为 CPU 核数")
 
     args = parser.parse_args()
 
     if args.runserver == 'runserver':
         if args.crawler:
             # 只启动爬虫
-            start_multi_server(args.count, args.port)
+            start_multi_server(args.count, args.port, args.mode, args.sockets, args.sample, args.ipv6)
         elif args.convert:
             # 只启动转换
-            start_magnet_converter()
+            CONVERTERS[args.converter]()
         else:
             # 全部启动
-            crawler_args = (args.count, args.port,)
+            crawler_args = (args.count, args.port, args.mode, args.sockets, args.sample, args.ipv6,)
             converter_args = ()
-            start_all(crawler_args, converter_args)
+            start_all(crawler_args, converter_args, CONVERTERS[args.converter])
     elif args.runserver == 'createdatabase':
         create_tables(args.createdatabase)
+    elif args.runserver == 'migrate':
+        # 把 magnet 字符串迁移为 20 字节的 info_hash
+        migrate_all(args.createdatabase)
+    elif args.runserver == 'search':
+        sqlite = SqliteClient(args.createdatabase)
+        for info_hash, name, length, file_count, create_date in sqlite.search(args.keyword or ''):
+            print(info_hash.hex(), name, length, file_count, create_date)
+        sqlite.close()
+    elif args.runserver == 'import':
+        # 把目录里还没有写入数据库的种子文件批量导入
+        import_torrents(args.createdatabase, args.directory, args.workers)
+    elif args.runserver in ('pack', 'unpack', 'compact'):
+        # 种子文件和段文件之间的转换, 以及回收段文件里删除的空间
+        store = SegmentStore()
+        try:
+            if args.runserver == 'pack':
+                # 打包的同时写入数据库, 删除的种子文件不需要再 import
+                sqlite = SqliteClient(args.createdatabase)
+                try:
+                    print('{} torrents packed'.format(pack_directory(store, args.directory, sqlite)))
+                finally:
+                    sqlite.close()
+            elif args.runserver == 'unpack':
+                print('{} torrents unpacked'.format(unpack_directory(store, args.directory)))
+            else:
+                print('{} bytes reclaimed'.format(store.compact()))
+        finally:
+            store.close()
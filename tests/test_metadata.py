@@ -0,0 +1,143 @@
+"""
+用本地的假 peer 测试 ut_metadata 下载
+
+假 peer 用 asyncio.start_server 实现, 按 BEP 9/10 回复握手和 metadata 分块, 不需要连接真正的 DHT 网络
+"""
+import asyncio
+import hashlib
+import os
+import tempfile
+import unittest
+
+from bencoder import bencode, bdecode
+
+from magnet_crawler import metadata
+from magnet_crawler.metadata import MetadataFetcher, MetadataError, PeerFinder, fetch_metadata, encode_extended, \
+    read_message, PROTOCOL_HEADER, RESERVED, METADATA_PIECE_SIZE
+from magnet_crawler.routing import RoutingTable
+from magnet_crawler.utils import pack_peer
+
+# 假 peer 使用的 ut_metadata 扩展 id, 故意和我们的不一样
+PEER_UT_METADATA_ID = 3
+INFO = bencode({b'name': b'test', b'piece length': 16384, b'pieces': os.urandom(20 * 2000), b'length': 123})
+INFO_HASH = hashlib.sha1(INFO).digest()
+
+
+async def fake_peer(reader, writer, mode='good'):
+    """
+    mode: good 正常回复; corrupt 发来的分块内容不对; bad_handshake 扩展握手不是合法的 bencode;
+    slow 收到请求后不回复
+    """
+    try:
+        handshake = await reader.readexactly(68)
+        writer.write(PROTOCOL_HEADER + RESERVED + handshake[28:48] + b'p' * 20)
+        if mode == 'bad_handshake':
+            writer.write(encode_extended(0, b'd1:md11:ut_metadatai3e'))
+        else:
+            writer.write(encode_extended(0, bencode({b'm': {b'ut_metadata': PEER_UT_METADATA_ID},
+                                                     b'metadata_size': len(INFO)})))
+        await writer.drain()
+        while True:
+            message = await read_message(reader)
+            if not message or message[0] != 20 or message[1] != PEER_UT_METADATA_ID:
+                continue
+            piece = bdecode(message[2:])[b'piece']
+            if mode == 'slow':
+                await asyncio.sleep(60)
+            chunk = INFO[piece * METADATA_PIECE_SIZE:(piece + 1) * METADATA_PIECE_SIZE]
+            if mode == 'corrupt':
+                chunk = b'x' * len(chunk)
+            header = bencode({b'msg_type': 1, b'piece': piece, b'total_size': len(INFO)})
+            writer.write(encode_extended(metadata.UT_METADATA_ID, header + chunk))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+class FakeDHTNode(asyncio.DatagramProtocol):
+    """对 get_peers 回复一个固定的 peer"""
+
+    def __init__(self, peer):
+        self.nid = os.urandom(20)
+        self.peer = peer
+        self.transport = None
+        self.queries = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        data = bdecode(data)
+        self.queries.append(data[b'a'][b'info_hash'])
+        self.transport.sendto(bencode({b't': data[b't'], b'y': b'r',
+                                       b'r': {b'id': self.nid, b'values': [pack_peer(*self.peer)]}}), addr)
+
+
+class MetadataFetcherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.servers = []
+
+    async def asyncTearDown(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+
+    async def start_peer(self, mode='good'):
+        server = await asyncio.start_server(lambda r, w: fake_peer(r, w, mode), '127.0.0.1', 0)
+        self.servers.append(server)
+        return '127.0.0.1', server.sockets[0].getsockname()[1]
+
+    async def test_fetch_metadata(self):
+        address = await self.start_peer()
+        self.assertEqual(await fetch_metadata(INFO_HASH, address, b'-MC0001-' + b'0' * 12), INFO)
+
+    async def test_corrupt_metadata(self):
+        address = await self.start_peer('corrupt')
+        with self.assertRaises(MetadataError):
+            await fetch_metadata(INFO_HASH, address, b'-MC0001-' + b'0' * 12)
+
+    async def test_bad_peer_does_not_abort_fetch(self):
+        peers = [await self.start_peer('bad_handshake'), await self.start_peer('corrupt'),
+                 await self.start_peer('slow'), await self.start_peer()]
+        fetcher = MetadataFetcher(None, timeout=10)
+        self.assertEqual(await fetcher.fetch(INFO_HASH, peers), INFO)
+        self.assertEqual((fetcher.fetched, fetcher.failed, fetcher.known_peer_fetched), (1, 0, 1))
+        self.assertGreaterEqual(fetcher.peer_errors, 2)
+
+    async def test_all_peers_fail(self):
+        peers = [await self.start_peer('bad_handshake'), await self.start_peer('corrupt')]
+        fetcher = MetadataFetcher(None, timeout=10)
+        self.assertIsNone(await fetcher.fetch(INFO_HASH, peers))
+        self.assertEqual((fetcher.fetched, fetcher.failed, fetcher.peer_errors), (0, 1, 2))
+
+
+class PeerFinderTest(unittest.IsolatedAsyncioTestCase):
+    async def test_lookup_starts_from_snapshot(self):
+        loop = asyncio.get_running_loop()
+        transport, node = await loop.create_datagram_endpoint(lambda: FakeDHTNode(('8.8.8.8', 6881)),
+                                                              local_addr=('127.0.0.1', 0))
+        address = transport.get_extra_info('sockname')
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            table = RoutingTable(os.urandom(20))
+            table.add(node.nid, *address)
+            table.mark_seen(address)
+            table.save(os.path.join(snapshot_dir, 'nodes-1.dat'))
+            # 没有引导节点, 只能从快照里的节点开始查找
+            finder = PeerFinder(bootstrap_nodes=(), snapshot_dir=snapshot_dir)
+            await finder.start('127.0.0.1')
+        try:
+            for info_hash in (INFO_HASH, os.urandom(20)):
+                peers = [peer async for peer in finder.find_peers(info_hash)]
+                self.assertEqual(peers, [('8.8.8.8', 6881)])
+            self.assertEqual(len(node.queries), 2)
+            self.assertIn(address, finder.routing_table)
+            self.assertEqual(finder.routing_table.get(address).fails, 0)
+        finally:
+            finder.close()
+            transport.close()
+
+
+if __name__ == '__main__':
+    unittest.main()